@@ -21,6 +21,8 @@ async def init_db():
 
     await db.set_bind(app.config["DATABASE_URL"])
 
+    # `query="like"`字段的GIN索引需要pg_trgm
+    await db.status("CREATE EXTENSION IF NOT EXISTS pg_trgm")
     await db.gino.create_all()
 
 
@@ -29,7 +31,7 @@ async def create_admin(username, pwd):
     from cat_and_dog.modules.users.models import User
     await db.set_bind(app.config["DATABASE_URL"])
     user = User()
-    user.password = pwd
+    await user.set_password(pwd)
     user.mobile = username
     user.nick_name = username
     user.is_admin = True
@@ -39,10 +41,9 @@ async def create_admin(username, pwd):
 if __name__ == "__main__":
     # use sanic server to handler the request
     if app.config.get("DEBUG") is False:
-        import multiprocessing
-
         # use nginx to handle the access log..
         # TODO: use uvicorn to start the app. there are some compatibility issues.
-        app.run(port=5000, auto_reload=False, workers=multiprocessing.cpu_count() * 2 + 1, access_log=False)
+        # 连接池的大小按照`WORKERS`分配, 没有配置时的默认值见`Gino.size_pool`
+        app.run(port=5000, auto_reload=False, workers=app.config["WORKERS"], access_log=False)
     else:
         app.run(port=5000, auto_reload=True)
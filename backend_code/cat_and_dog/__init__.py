@@ -10,11 +10,14 @@ from sanic.response import json, HTTPResponse
 from sanic_session import Session, AIORedisSessionInterface
 
 from cat_and_dog.config.log_config import logconfig_dict, error_logger
-from cat_and_dog.modules import db
+from cat_and_dog.modules import db, detail_cache, user_cache, password_hasher
 from cat_and_dog.modules.auth import auth_bp, login_manager
 from cat_and_dog.modules.product import product_bp
 from cat_and_dog.modules.public import public_bp
 from cat_and_dog.utils.errors.exceptions import SchemaException, ApiException
+from cat_and_dog.utils.login.session import SignedSessionInterface
+from cat_and_dog.utils.request.compress import compress
+from cat_and_dog.utils.relations.identity_map import IdentityMap
 from cat_and_dog.utils.request.request import MyRequest
 from .config import log_config, dev, pro
 
@@ -35,7 +38,22 @@ def set_session(app: Sanic):
     @app.listener('before_server_start')
     async def server_init(app, loop):
         app.redis = await aioredis.create_redis_pool(app.config["REDIS"], loop=loop, db=15)
-        Session(app, interface=AIORedisSessionInterface(app.redis))
+        if app.config.get("SESSION_INTERFACE") == "signed":
+            # 签名的cookie, 只有登出时才会写入redis
+            interface = SignedSessionInterface(app.redis,
+                                               keys=app.config["SESSION_KEYS"],
+                                               encrypt=app.config.get("SESSION_ENCRYPT", False),
+                                               expiry=app.config.get("SESSION_EXPIRY", 2592000))
+            interface.start(loop, app.config["REDIS"])
+        else:
+            interface = AIORedisSessionInterface(app.redis)
+        Session(app, interface=interface)
+
+    @app.listener("before_server_stop")
+    async def stop_session(app, loop):
+        session = getattr(app.ctx, "extensions", dict()).get("session")
+        if session is not None and isinstance(session.interface, SignedSessionInterface):
+            session.interface.stop()
 
     @app.listener("my_signal")
     async def signal(sender, data):
@@ -79,11 +97,12 @@ def error_handle(app: Sanic):
 
 
 def middleware(app: Sanic):
-    @app.middleware("response")
-    async def format_data(_, response):
-        if 200 <= response.status < 300 and getattr(response, 'content_type', None) == "application/json":
-            data = f'{{"message": "ok", "data": {response.body.decode()} }}'
-            response.body = data.encode()
+    async def bind_identity_map(request):
+        """每个请求使用独立的identity map, 同一行数据在一个请求中只会加载一次"""
+        request.ctx.identity_map = IdentityMap()
+        request.ctx.identity_map.bind()
+
+    app.request_middleware.appendleft(bind_identity_map)
 
 
 def create_app(mode: str) -> Sanic:
@@ -104,6 +123,15 @@ def create_app(mode: str) -> Sanic:
     # 关联db
     db.init_app(app)
 
+    # 详情缓存
+    detail_cache.init_app(app)
+
+    # 登录用户的缓存
+    user_cache.init_app(app)
+
+    # 在executor中计算密码的hash
+    password_hasher.init_app(app)
+
     # 注册蓝图
     register_bp(app)
 
@@ -113,6 +141,10 @@ def create_app(mode: str) -> Sanic:
     # 中间件
     middleware(app)
 
+    # 压缩响应, 没有nginx时使用
+    if app.config.get("COMPRESS", True):
+        compress.init_app(app)
+
     @app.route("/signal")
     async def send_a_signal(request: MyRequest):
         a = await request.app.send_signal("my_signal", request)
@@ -140,7 +172,7 @@ def create_app(mode: str) -> Sanic:
     @app.route("/logout")
     async def logout(request):
         # from cat_and_dog.modules.users.models import User
-        request.logout()
+        await request.logout()
         return HTTPResponse(1)
 
     @app.websocket('/feed')
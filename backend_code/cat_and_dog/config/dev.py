@@ -1,6 +1,5 @@
 import getpass
-
-from gino.dialects.asyncpg import Pool
+import os
 
 user = getpass.getuser()
 
@@ -17,11 +16,58 @@ DB_ECHO = False
 REDIS = "redis://localhost"
 STATIC_PATH = "./static"
 
+# 进程数, 与启动时的workers一致; 没有设置时为`cpu_count() * 2 + 1`(见`Gino.size_pool`), app.py使用同一个值启动
+WORKERS = int(os.environ["WEB_CONCURRENCY"]) if os.environ.get("WEB_CONCURRENCY") else None
+# 所有worker一共可以使用的连接数, 应该小于postgres的max_connections,
+# 每个worker的连接池大小为`DB_CONNECTION_BUDGET // WORKERS`, 也可以直接配置下面两项
+DB_CONNECTION_BUDGET = 20
 # DB_POOL_MIN_SIZE
 # DB_POOL_MAX_SIZE
 
+# 每个请求使用同一个连接, 连接在第一次查询时才从连接池获取, 返回响应时归还;
+# 没有查询数据库的请求(如缓存命中)不会占用连接
 DB_USE_CONNECTION_FOR_REQUEST = True
 
-DB_KWARGS = dict(
-    pool_class=Pool,
-)
+# 只读副本, GET请求的查询使用副本; 写入之后该客户端在`DB_REPLICA_STICKY_SECONDS`秒内使用主库
+DB_REPLICAS = ()
+DB_REPLICA_STICKY_SECONDS = 5
+
+# 详情接口缓存的过期时间(秒)
+DETAIL_CACHE_TTL = 300
+
+# 进程内缓存, 在redis缓存之前
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TTL = 60
+# 模型实例也缓存在进程内的表
+LOCAL_CACHE_MODELS = ("categories", "brands")
+
+# 批量接口每个事务写入的行数
+BULK_BATCH_SIZE = 1000
+
+# "signed": session保存在签名的cookie中, 不需要每个请求都读写redis; "redis": 保存在redis中
+SESSION_INTERFACE = "signed"
+# 第一个密钥用于签名, 其他的只用于验证; 轮换时将新密钥放在最前面, 旧密钥在session过期之后再删除
+SESSION_KEYS = [os.environ.get("SESSION_KEY", "dev-session-key")]
+# 加密session的内容, 需要安装cryptography
+SESSION_ENCRYPT = False
+SESSION_EXPIRY = 2592000
+
+# 密码hash的参数, 见werkzeug的`generate_password_hash`, 修改之后原来的hash仍然可以验证
+PASSWORD_HASH_METHOD = "scrypt"
+PASSWORD_HASH_SALT_LENGTH = 16
+# hash在executor中计算, 同时计算的数量, 超过`PASSWORD_HASH_QUEUE`的登录请求直接返回429
+PASSWORD_HASH_EXECUTOR = "thread"
+PASSWORD_HASH_CONCURRENCY = 2
+PASSWORD_HASH_QUEUE = 32
+
+# 按照Accept-Encoding压缩响应, 安装brotli/zstandard时优先使用; 已经有nginx压缩时可以关闭
+COMPRESS = True
+COMPRESS_MIN_SIZE = 1024
+# 超过该大小的响应在线程池中压缩
+COMPRESS_EXECUTOR_SIZE = 64 * 1024
+COMPRESS_LEVEL = 6
+
+# 登录用户的缓存, 修改用户时失效; 其他worker的进程内缓存最多`USER_CACHE_LOCAL_TTL`秒之后失效,
+# 即被禁用或者取消管理员的用户在其他worker中最多还能以原来的权限访问`USER_CACHE_LOCAL_TTL`秒
+USER_CACHE_TTL = 60
+USER_CACHE_LOCAL_TTL = 5
@@ -1,32 +1,213 @@
+import multiprocessing
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from itertools import cycle
+from time import time
 
 import ujson
+from gino import create_engine
 from gino.ext.sanic import Gino as _Gino
 from marshmallow import fields
 from sqlalchemy import *
 
 from cat_and_dog.utils.async_schema.schema import Schema
+from cat_and_dog.utils.cache.detail_cache import DetailCache
+from cat_and_dog.utils.cache.lru import CompiledCache
+from cat_and_dog.utils.cache.user_cache import UserCache
+from cat_and_dog.utils.login.hashing import PasswordHasher
+from cat_and_dog.utils.pool import MeteredPool, pool_metrics
+from cat_and_dog.utils.relations.identity_map import current_identity_map
 from cat_and_dog.utils.relations.orm_relations import setup_base
+from cat_and_dog.utils.routing import current_replica, use_replica, stick_to_primary, has_written, \
+    current_connection, use_connection, primary
+
+
+# 当前`auto_commit`事务提交之后需要执行的回调, 见`Gino.after_commit`
+_after_commit = ContextVar("after_commit", default=None)
 
 
 class Gino(_Gino):
+    """
+    支持只读副本: 配置`DB_REPLICAS`之后, GET/HEAD请求的查询会轮流使用副本,
+    `auto_commit`之后当前请求改为使用主库, 并且该客户端在`DB_REPLICA_STICKY_SECONDS`秒内的请求都使用主库
+    """
+    pool_max_size = 10
+    # 批量写入时每个事务的行数
+    bulk_batch_size = 1000
+
+    STICKY_COOKIE = "db_primary_until"
+
+    def __init__(self, *args, **kwargs):
+        # sqlalchemy以语句对象为key缓存编译的结果, 只缓存`MixInBase.shape_statement`复用的语句对象
+        self.compiled_cache = CompiledCache(maxsize=512, ttl=float("inf"))
+        self.replicas = list()
+        self._next_replica = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def bind(self):
+        """当前context使用的连接或者engine, 见`cat_and_dog.utils.routing`"""
+        connection = current_connection()
+        return connection if connection is not None else self.engine
+
+    @property
+    def engine(self):
+        """当前请求使用的engine(主库或者副本)"""
+        replica = current_replica()
+        return replica if replica is not None else self.primary_bind
+
+    @bind.setter
+    def bind(self, bind):
+        _Gino.bind.fset(self, bind)
+
+    @property
+    def primary_bind(self):
+        return _Gino.bind.fget(self)
+
+    def init_app(self, app):
+        self.size_pool(app.config)
+        # 记录获取连接的等待时间, 见/stats; 主库以及副本的连接池都使用
+        app.config.setdefault("DB_KWARGS", dict()).setdefault("pool_class", MeteredPool)
+        # 需要在gino_sanic获取请求的连接之前选择engine
+        self.init_replicas(app)
+        super().init_app(app)
+        self.pool_max_size = app.config["DB_POOL_MAX_SIZE"]
+        self.bulk_batch_size = app.config.setdefault("BULK_BATCH_SIZE", 1000)
+        self.compiled_cache.maxsize = app.config.setdefault("COMPILED_CACHE_SIZE", 512)
+
+        # gino_sanic在`after_server_start`中才会创建连接池
+        @app.listener("after_server_start")
+        async def enable_compiled_cache(_, loop):
+            self.primary_bind.update_execution_options(compiled_cache=self.compiled_cache)
+            for engine in self.replicas:
+                engine.update_execution_options(compiled_cache=self.compiled_cache)
+
+    def init_replicas(self, app):
+        dsns = app.config.setdefault("DB_REPLICAS", ())
+        sticky_seconds = app.config.setdefault("DB_REPLICA_STICKY_SECONDS", 5)
+        if not dsns:
+            return
+
+        @app.listener("after_server_start")
+        async def connect_replicas(_, loop):
+            for dsn in dsns:
+                engine = await create_engine(dsn,
+                                             strategy="sanic",
+                                             loop=loop,
+                                             echo=app.config["DB_ECHO"],
+                                             min_size=app.config["DB_POOL_MIN_SIZE"],
+                                             max_size=app.config["DB_POOL_MAX_SIZE"],
+                                             **app.config["DB_KWARGS"])
+                self.replicas.append(engine)
+            self._next_replica = cycle(self.replicas)
+
+        @app.listener("before_server_stop")
+        async def close_replicas(_, loop):
+            replicas, self.replicas, self._next_replica = self.replicas, list(), None
+            for engine in replicas:
+                await engine.close()
+
+        @app.middleware("request")
+        async def route_to_replica(request):
+            if request.method not in ("GET", "HEAD") or self._next_replica is None:
+                return
+            # 刚刚写入过数据的客户端继续使用主库
+            if float(request.cookies.get(self.STICKY_COOKIE) or 0) > time():
+                return
+            use_replica(next(self._next_replica))
+
+        @app.middleware("response")
+        async def remember_write(request, response):
+            if has_written():
+                response.cookies[self.STICKY_COOKIE] = str(int(time()) + sticky_seconds)
+                response.cookies[self.STICKY_COOKIE]["max-age"] = sticky_seconds
+
+    @staticmethod
+    def size_pool(config) -> None:
+        """
+        每个worker的连接池大小: `DB_CONNECTION_BUDGET // WORKERS`,
+        使所有worker的连接数不会超过postgres的`max_connections`
+
+        没有配置`WORKERS`时使用`cpu_count() * 2 + 1`并写回配置, 启动时(app.py)使用同一个值;
+        明确配置了`DB_POOL_MAX_SIZE`时以配置为准
+        """
+        config["WORKERS"] = config.get("WORKERS") or multiprocessing.cpu_count() * 2 + 1
+        budget = config.get("DB_CONNECTION_BUDGET")
+        if budget:
+            config.setdefault("DB_POOL_MAX_SIZE", max(1, budget // config["WORKERS"]))
+            # 连接在第一次查询时才获取, 不需要预先建立很多连接
+            config.setdefault("DB_POOL_MIN_SIZE", 1)
+        config.setdefault("DB_POOL_MIN_SIZE", 5)
+        config.setdefault("DB_POOL_MAX_SIZE", 10)
+        config["DB_POOL_MIN_SIZE"] = min(config["DB_POOL_MIN_SIZE"], config["DB_POOL_MAX_SIZE"])
+
+    def pool_stats(self) -> dict:
+        """连接池的大小, 空闲的连接数以及获取连接的等待时间"""
+        pool = self.primary_bind.raw_pool
+        return {
+            "size": pool.get_size(),
+            "idle": pool.get_idle_size(),
+            "max": pool.get_max_size(),
+            **pool_metrics.stats(),
+        }
+
+    @asynccontextmanager
+    async def isolated_connection(self):
+        """
+        获取一个新的连接, with中(当前context)的查询都使用该连接, 用于并发的子任务, 同一个连接上不能同时执行多个查询
+
+        新的连接不放入gino的连接栈(`reusable=False`), 子任务复制context之后会和父任务共用同一个栈
+        """
+        async with self.engine.acquire(reuse=False, reusable=False) as conn:
+            with use_connection(conn):
+                yield conn
+
     @asynccontextmanager
     async def auto_commit(self):
-        async with self.transaction() as tx:
-            try:
-                yield
-                await tx.raise_commit()
-            except Exception as e:
+        """最外层的`auto_commit`提交之后执行`after_commit`注册的回调, 回滚时丢弃"""
+        stick_to_primary()
+        outermost = _after_commit.get() is None
+        token = _after_commit.set(list()) if outermost else None
+        try:
+            async with self.transaction() as tx:
                 try:
-                    await tx.rollback()
-                except AssertionError:
-                    pass
-                raise e
+                    yield
+                    await tx.raise_commit()
+                except Exception as e:
+                    try:
+                        await tx.rollback()
+                    except AssertionError:
+                        pass
+                    raise e
+
+            if outermost:
+                for callback in _after_commit.get():
+                    await callback()
+        finally:
+            if outermost:
+                _after_commit.reset(token)
+
+    @staticmethod
+    async def after_commit(callback) -> None:
+        """
+        在当前`auto_commit`的事务提交之后执行, 如: 使缓存失效, 避免提交之前并发的请求将旧的数据重新写入缓存;
+        不在`auto_commit`中时立即执行
+        :param callback: 没有参数的async function
+        """
+        callbacks = _after_commit.get()
+        if callbacks is None:
+            await callback()
+        else:
+            callbacks.append(callback)
 
 
 db = Gino()
 
+detail_cache = DetailCache()
+user_cache = UserCache()
+password_hasher = PasswordHasher()
+
 
 @setup_base
 class Base(db.Model):
@@ -35,6 +216,41 @@ class Base(db.Model):
 
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
 
+    @classmethod
+    async def get(cls, ident, *args, **kwargs):
+        """
+        只用于读取: 当前请求中已经加载的实例直接从identity map中返回(见`RelationMixin.get`),
+        否则`LOCAL_CACHE_MODELS`中的热点数据(如分类, 品牌)从进程内的缓存中读取, 可能不是最新的值;
+        需要修改的实例使用`get_for_update`
+        """
+        get = super().get
+        if args or kwargs:
+            return await get(ident, *args, **kwargs)
+        return await detail_cache.get_instance(cls, ident, lambda: get(ident))
+
+    @classmethod
+    async def get_for_update(cls, ident):
+        """
+        需要修改的实例: 不经过缓存, 从主库读取并锁定该行(`SELECT ... FOR UPDATE`), 应该在事务中调用;
+        identity map中原来的实例(可能来自缓存)会被新读取的实例替换
+        """
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.discard(cls, ident)
+        with primary():
+            return await cls.query.where(cls.id == ident).with_for_update().gino.first()
+
+
+def trgm_index(table_name: str, column_name: str) -> Index:
+    """
+    pg_trgm的GIN索引, 使`LIKE '%value%'`的模糊查询可以使用索引, 需要`CREATE EXTENSION pg_trgm`
+
+        __table_args__ = (trgm_index("brands", "name"),)
+    """
+    return Index(f"ix_{table_name}_{column_name}_trgm", column_name,
+                 postgresql_using="gin",
+                 postgresql_ops={column_name: "gin_trgm_ops"})
+
 
 class RecordingMixin:
     # 表示状态, 商品是否上架, 用户是否激活等
@@ -53,3 +269,14 @@ class BaseSchema(Schema):
     status = fields.Integer()
     update_time = fields.DateTime(dump_only=True)
     create_time = fields.DateTime(dump_only=True)
+
+    def concurrency_limit(self) -> int:
+        """`Meta.concurrency = True`时使用连接池大小, 并且为当前请求的连接保留一个"""
+        limit = self.opts.concurrency
+        if limit is True:
+            limit = db.pool_max_size
+        return min(limit, db.pool_max_size - 1)
+
+    def concurrent_scope(self):
+        """每一项使用独立的连接"""
+        return db.isolated_connection()
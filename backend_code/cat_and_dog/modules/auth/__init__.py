@@ -1,6 +1,7 @@
 from sanic import Blueprint
 
 from cat_and_dog.utils.login.manager import LoginManager
+from .. import user_cache
 from ..users.models import User
 
 from .api import Auth
@@ -16,4 +17,4 @@ login_manager = LoginManager()
 
 @login_manager.user_loader
 async def get_user(pk):
-    return await User.get(pk)
+    return await user_cache.get(User, pk)
@@ -1,4 +1,4 @@
-from sanic.response import json
+from cat_and_dog.utils.request.response import json
 from sanic.views import HTTPMethodView
 
 from cat_and_dog.modules.auth.schema import AdminLogInSchema
@@ -8,16 +8,16 @@ from cat_and_dog.modules.users.schema import UserDetailSchema
 class Auth(HTTPMethodView):
     async def get(self, request):
         """登出"""
-        request.logout()
+        await request.logout()
         return json({})
 
     async def post(self, request):
         """登录"""
-        user_load_schema = AdminLogInSchema(strict=True)
+        user_load_schema = AdminLogInSchema.shared(strict=True)
         user, error = await user_load_schema.async_load(request.json)
         request.login(user)  # 使用login_user状态保持
 
-        user_dump_schema = UserDetailSchema()
+        user_dump_schema = UserDetailSchema.shared()
         user_info = user_dump_schema.dump(user).data
 
         return json(user_info)
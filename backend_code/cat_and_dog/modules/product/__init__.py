@@ -1,24 +1,35 @@
 from sanic import Blueprint
 
-from .brand.api import Brand, BrandCount, Brands
-from .category.api import Categories, Category, CountForCategories
-from .goods.api import Spus, SpusCount, Spu, Skus, SkusCount, Sku
+from .brand.api import Brand, BrandCount, Brands, BrandBulk, BrandExport
+from .category.api import Categories, Category, CountForCategories, CategoryTree, CategoryBulk, \
+    CategoryExport
+from .goods.api import Spus, SpusCount, Spu, Skus, SkusCount, Sku, SpusBulk, SkusBulk, \
+    SpusExport, SkusExport
 from ..api_version import api_prefix
 
 product_bp = Blueprint("product", url_prefix=api_prefix)
 
 product_bp.add_route(Categories.as_view(), "categories")
 product_bp.add_route(CountForCategories.as_view(), "categories/count")
+product_bp.add_route(CategoryTree.as_view(), "categories/tree")
+product_bp.add_route(CategoryBulk.as_view(), "categories/bulk")
+product_bp.add_route(CategoryExport.as_view(), "categories/export")
 product_bp.add_route(Category.as_view(), "category/<pk:int>")
 
 product_bp.add_route(Spus.as_view(), "products")
 product_bp.add_route(SpusCount.as_view(), "products/count")
+product_bp.add_route(SpusBulk.as_view(), "products/bulk")
+product_bp.add_route(SpusExport.as_view(), "products/export")
 product_bp.add_route(Spu.as_view(), "product/<pk:int>")
 
 product_bp.add_route(Brands.as_view(), "brands")
 product_bp.add_route(BrandCount.as_view(), "brands/count")
+product_bp.add_route(BrandBulk.as_view(), "brands/bulk")
+product_bp.add_route(BrandExport.as_view(), "brands/export")
 product_bp.add_route(Brand.as_view(), "brand/<pk:int>")
 
 product_bp.add_route(Skus.as_view(), "skus")
 product_bp.add_route(Sku.as_view(), "sku/<pk:int>")
 product_bp.add_route(SkusCount.as_view(), "skus/count")
+product_bp.add_route(SkusBulk.as_view(), "skus/bulk")
+product_bp.add_route(SkusExport.as_view(), "skus/export")
@@ -1,25 +1,29 @@
-from sanic.response import json
+from functools import partial
+
+from sanic.response import stream
 from sanic.views import HTTPMethodView
 
 from cat_and_dog import db
+from cat_and_dog.modules import detail_cache
 from cat_and_dog.utils.errors.status_code import UPDATE_OK
 from cat_and_dog.utils.login.tools import admin_required
-from .schema import BrandListSchema, BrandDetailSchema, BrandCountSchema
+from cat_and_dog.utils.request.response import json, conditional_json
+from .schema import BrandListSchema, BrandDetailSchema, BrandCountSchema, BrandBulkSchema, BrandExportSchema
 from .models import Brand as ModelBrand
 
 
 class Brands(HTTPMethodView):
     async def get(self, request):
         """获取品牌列表"""
-        schema = BrandListSchema(strict=True)
+        schema = BrandListSchema.shared(strict=True)
         instance_list, error = await schema.async_load(request.single_args)
         data, error = await schema.async_dump(instance_list, many=True)
-        return json(data)
+        return conditional_json(request, data, **instance_list.meta)
 
     @admin_required
     async def post(self, request):
         """创建品牌"""
-        schema = BrandDetailSchema(strict=True)
+        schema = BrandDetailSchema.shared(strict=True)
         instance = (await schema.async_load(request.json)).data
         data, error = await schema.async_dump(instance)
         return json(data)
@@ -28,24 +32,27 @@ class Brands(HTTPMethodView):
 class Brand(HTTPMethodView):
     async def get(self, request, pk: int):
         """获取品牌详情"""
-        schema = BrandDetailSchema()
-        instance = await ModelBrand.get_or_404(pk)
-        data, error = await schema.async_dump(instance)
-        return json(data)
+        schema = BrandDetailSchema.shared()
+        entry = await detail_cache.get_entry(ModelBrand, pk, schema)
+        return conditional_json(request, entry["data"], entry["etag"], entry["last_modified"])
 
     @admin_required
     async def delete(self, request, pk: int):
         """删除品牌"""
+        stale = set()
         async with db.auto_commit():
-            # await ModelCategories.get(pk)
+            instance = await ModelBrand.get_for_update(pk)
+            if instance:
+                stale = await detail_cache.related(instance)
             res = await ModelBrand.delete.where(ModelBrand.id == pk).gino.status()
 
+        await detail_cache.invalidate(stale)
         return json({"res": res[0]})
 
     @admin_required
     async def put(self, request, pk: int):
         """更新品牌"""
-        schema = BrandDetailSchema(strict=True, partial=True)
+        schema = BrandDetailSchema.shared(strict=True, partial=True)
         data = request.json
         data['id'] = pk
         instance = (await schema.async_load(data)).data
@@ -55,6 +62,24 @@ class Brand(HTTPMethodView):
 
 class BrandCount(HTTPMethodView):
     async def get(self, request):
-        schema = BrandCountSchema(strict=True)
+        schema = BrandCountSchema.shared(strict=True)
         count, error = await schema.async_load(request.single_args)
-        return json({"count": count})
+        return json(count)
+
+
+class BrandBulk(HTTPMethodView):
+    @admin_required
+    async def post(self, request):
+        """批量创建/更新品牌, 接受JSON数组或者NDJSON"""
+        schema = BrandBulkSchema.shared(strict=True, many=True)
+        result, error = await schema.async_load(request.json_rows)
+        return json(result, status=UPDATE_OK)
+
+
+class BrandExport(HTTPMethodView):
+    @admin_required
+    async def get(self, request):
+        """导出品牌, 返回NDJSON"""
+        schema = BrandExportSchema.shared(strict=True)
+        query, error = await schema.async_load(request.single_args)
+        return stream(partial(schema.export, query), content_type="application/x-ndjson")
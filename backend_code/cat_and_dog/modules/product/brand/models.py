@@ -3,7 +3,7 @@
 from sqlalchemy import *
 # from sqlalchemy.orm import relationship
 
-from cat_and_dog.modules import Base, RecordingMixin
+from cat_and_dog.modules import Base, RecordingMixin, trgm_index
 from cat_and_dog.utils.relations.orm_relations import one2many
 
 
@@ -12,6 +12,7 @@ class Brand(RecordingMixin, Base):
     苹果, 华为, 小米
     """
     __tablename__ = "brands"
+    __table_args__ = (trgm_index("brands", "name"),)
 
     name = Column(String(255), index=True, nullable=False, unique=True)
     # spus = relationship("Spu", backref="brand", lazy="dynamic")
@@ -1,6 +1,7 @@
 from marshmallow import fields
 
-from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn, PreLoadListMixin
+from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn, PreLoadListMixin, BulkMixIn, \
+    ExportMixIn
 from .models import Brand
 from ..goods.models import Spu
 from ... import BaseSchema
@@ -11,7 +12,17 @@ class BrandBase(BaseSchema):
     name = fields.String(query="like")
 
 
-class BrandListSchema(PreLoadListMixin, ListMixin, BrandBase):
+class BrandListBase(BrandBase):
+    """列表和导出共用的字段"""
+    # dump_only
+    spus_nums = fields.Integer(dump_only=True, annotate="count", model=Spu, fk="brand_id")
+
+
+class BrandListSchema(PreLoadListMixin, ListMixin, BrandListBase):
+    pass
+
+
+class BrandExportSchema(PreLoadListMixin, ExportMixIn, BrandListBase):
     pass
 
 
@@ -33,3 +44,10 @@ class BrandDetailSchema(DetailMixIn, BrandBase):
 
     # dump_only
     spus = fields.Nested("SpuDetailSchema", only=("id", "name"), many=True, dump_only=True)
+
+
+class BrandBulkSchema(BulkMixIn, BrandBase):
+    __conflict_key__ = "name"
+
+    id = fields.Integer(dump_only=True)
+    name = fields.String(required=True)
@@ -1,26 +1,31 @@
 # -*- coding: utf-8 -*-
-from sanic.response import json
+from functools import partial
+
+from sanic.response import stream
 from sanic.views import HTTPMethodView
 
 from cat_and_dog import db
+from cat_and_dog.modules import detail_cache
 from cat_and_dog.utils.errors.status_code import UPDATE_OK
 from cat_and_dog.utils.login.tools import admin_required
-from .schema import CateListSchema, CateDetailSchema, CateCountSchema
+from cat_and_dog.utils.request.response import json, conditional_json
+from .schema import CateListSchema, CateDetailSchema, CateCountSchema, CateTreeSchema, CateBulkSchema, \
+    CateExportSchema
 from .models import Categories as ModelCategories
 
 
 class Categories(HTTPMethodView):
     async def get(self, request):
         """获取分类列表"""
-        schema = CateListSchema(strict=True)
+        schema = CateListSchema.shared(strict=True)
         instance_list, error = await schema.async_load(request.single_args)
         data, error = await schema.async_dump(instance_list, many=True)
-        return json(data)
+        return conditional_json(request, data, **instance_list.meta)
 
     @admin_required
     async def post(self, request):
         """创建分类"""
-        schema = CateDetailSchema(strict=True)
+        schema = CateDetailSchema.shared(strict=True)
         instance = (await schema.async_load(request.json)).data
         data, error = await schema.async_dump(instance)
         return json(data)
@@ -30,24 +35,27 @@ class Category(HTTPMethodView):
     # @admin_required
     async def get(self, request, pk: int):
         """获取分类详情"""
-        schema = CateDetailSchema()
-        instance = await ModelCategories.get_or_404(pk)
-        data, error = await schema.async_dump(instance)
-        return json(data)
+        schema = CateDetailSchema.shared()
+        entry = await detail_cache.get_entry(ModelCategories, pk, schema)
+        return conditional_json(request, entry["data"], entry["etag"], entry["last_modified"])
 
     @admin_required
     async def delete(self, request, pk: int):
         """删除分类"""
+        stale = set()
         async with db.auto_commit():
-            # await ModelCategories.get(pk)
+            instance = await ModelCategories.get_for_update(pk)
+            if instance:
+                stale = await detail_cache.related(instance)
             res = await ModelCategories.delete.where(ModelCategories.id == pk).gino.status()
 
+        await detail_cache.invalidate(stale)
         return json({"res": res[0]})
 
     @admin_required
     async def put(self, request, pk: int):
         """更新分类"""
-        schema = CateDetailSchema(strict=True, partial=True)
+        schema = CateDetailSchema.shared(strict=True, partial=True)
         data = request.json
         data['id'] = pk
         instance = (await schema.async_load(data)).data
@@ -57,6 +65,33 @@ class Category(HTTPMethodView):
 
 class CountForCategories(HTTPMethodView):
     async def get(self, request):
-        schema = CateCountSchema(strict=True)
+        schema = CateCountSchema.shared(strict=True)
         count, error = await schema.async_load(request.single_args)
-        return json({"count": count})
+        return json(count)
+
+
+class CategoryTree(HTTPMethodView):
+    async def get(self, request):
+        """获取分类树, 可以通过root指定根节点"""
+        schema = CateTreeSchema.shared(strict=True)
+        roots, error = await schema.async_load(request.single_args)
+        data, error = await schema.async_dump(roots, many=True)
+        return json(data)
+
+
+class CategoryBulk(HTTPMethodView):
+    @admin_required
+    async def post(self, request):
+        """批量创建/更新分类, 接受JSON数组或者NDJSON"""
+        schema = CateBulkSchema.shared(strict=True, many=True)
+        result, error = await schema.async_load(request.json_rows)
+        return json(result, status=UPDATE_OK)
+
+
+class CategoryExport(HTTPMethodView):
+    @admin_required
+    async def get(self, request):
+        """导出分类, 返回NDJSON"""
+        schema = CateExportSchema.shared(strict=True)
+        query, error = await schema.async_load(request.single_args)
+        return stream(partial(schema.export, query), content_type="application/x-ndjson")
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from sqlalchemy import *
+from sqlalchemy.dialects.postgresql import array
 
 from cat_and_dog.modules import Base, db, RecordingMixin
-from cat_and_dog.utils.relations.orm_relations import many2one, one2many
+from cat_and_dog.utils.errors.exceptions import TREE_TOO_DEEP
+from cat_and_dog.utils.relations.orm_relations import many2one, one2many, any_of
 
 
 class Categories(RecordingMixin, Base):
@@ -21,5 +23,116 @@ class Categories(RecordingMixin, Base):
     parent = many2one("Categories")
     children = one2many("Categories")
 
+    # 分类树的最大深度, 超过时抛出`TREE_TOO_DEEP`而不是截断; 循环引用由递归查询中的path检测
+    TREE_MAX_DEPTH = 64
+
     async def count_child(self):
         return await db.scalar("SELECT COUNT(*) FROM categories where parent_id = $1", self.id)
+
+    @classmethod
+    def tree_cte(cls, anchor, up=False, max_depth=TREE_MAX_DEPTH):
+        """
+        分类树的递归查询, 一次查询取出所有的祖先(up=True)或者子孙(up=False)
+
+        WITH RECURSIVE tree(root_id, id, parent_id, depth, path, is_cycle) AS (
+            SELECT id, id, parent_id, 0, ARRAY[id], false FROM categories WHERE <anchor>
+            UNION ALL
+            SELECT tree.root_id, c.id, c.parent_id, tree.depth + 1, tree.path || c.id, c.id = ANY(tree.path)
+            FROM categories AS c, tree
+            WHERE c.parent_id = tree.id  -- up: c.id = tree.parent_id
+              AND NOT tree.is_cycle
+              AND tree.depth <= <max_depth>
+        )
+
+        `is_cycle`的行表示回到了path中已有的分类, 递归在该行停止;
+        深度超过`max_depth`时会多查询一层, 由`check_depth`抛出异常, 不会静默截断
+
+        :param anchor: 起始分类的查询条件
+        :param up: 向上查询祖先或者向下查询子孙
+        :param max_depth: 最大的递归深度
+        :return: cte, `root_id`为起始分类的id, `depth`为0时表示起始分类本身
+        """
+        tree = select([cls.id.label("root_id"),
+                       cls.id,
+                       cls.parent_id,
+                       literal_column("0").label("depth"),
+                       array([cls.id]).label("path"),
+                       false().label("is_cycle")]).where(anchor).cte("tree", recursive=True)
+
+        node = cls.__table__.alias()
+        on = (node.c.id == tree.c.parent_id) if up else (node.c.parent_id == tree.c.id)
+        recursive = select([tree.c.root_id,
+                            node.c.id,
+                            node.c.parent_id,
+                            tree.c.depth + literal_column("1"),
+                            func.array_append(tree.c.path, node.c.id).label("path"),
+                            (node.c.id == any_(tree.c.path)).label("is_cycle")]). \
+            where(and_(on, not_(tree.c.is_cycle), tree.c.depth <= max_depth))
+
+        return tree.union_all(recursive)
+
+    @classmethod
+    def check_depth(cls, rows, max_depth=TREE_MAX_DEPTH) -> None:
+        """rows: `tree_cte`的行, 需要包含`depth`"""
+        if any(row["depth"] > max_depth for row in rows):
+            raise TREE_TOO_DEEP
+
+    @classmethod
+    async def ancestors(cls, pk: int) -> list:
+        """
+        分类的所有祖先id, 由近及远
+        :param pk: 分类id
+        :return: [parent_id, grandparent_id, ...]
+        """
+        tree = cls.tree_cte(cls.id == pk, up=True)
+        rows = await db.select([tree.c.id, tree.c.depth]). \
+            where(and_(tree.c.depth > 0, not_(tree.c.is_cycle))). \
+            order_by(tree.c.depth).gino.all()
+        cls.check_depth(rows)
+        return [r["id"] for r in rows]
+
+    @classmethod
+    async def parent_map(cls, ids) -> dict:
+        """
+        一次查询取出多个分类及其所有祖先的parent_id
+        :param ids: 分类id
+        :return: {id: parent_id}
+        """
+        tree = cls.tree_cte(any_of(cls.id, ids), up=True)
+        rows = await db.select([tree.c.id, tree.c.parent_id, tree.c.depth]).where(not_(tree.c.is_cycle)).gino.all()
+        cls.check_depth(rows)
+        return {r["id"]: r["parent_id"] for r in rows}
+
+    @classmethod
+    async def descendants(cls, pk: int = None) -> list:
+        """
+        分类及其所有子孙分类
+        :param pk: 分类id, 为None时返回所有的分类
+        :return: list of instances, 包括pk本身
+        """
+        anchor = cls.parent_id.is_(None) if pk is None else (cls.id == pk)
+        tree = cls.tree_cte(anchor)
+        rows = await db.select([tree.c.id, tree.c.depth]).where(not_(tree.c.is_cycle)).gino.all()
+        cls.check_depth(rows)
+        return await cls.query.where(any_of(cls.id, {r["id"] for r in rows})).order_by(cls.id).gino.all()
+
+    @classmethod
+    async def subtree_counts(cls, ids, max_depth=TREE_MAX_DEPTH) -> dict:
+        """
+        一次查询统计多个分类的子孙数量
+        :param ids: 分类id
+        :param max_depth: 统计的深度, 为1时只统计直接子类
+        :return: {id: count}
+        """
+        counts = dict.fromkeys(ids, 0)
+        if not counts:
+            return counts
+
+        tree = cls.tree_cte(any_of(cls.id, counts), max_depth=max_depth)
+        rows = await db.select([tree.c.root_id, func.count().label("count"), func.max(tree.c.depth).label("depth")]). \
+            where(and_(tree.c.depth > 0, not_(tree.c.is_cycle))). \
+            group_by(tree.c.root_id).gino.all()
+        cls.check_depth(rows, max_depth)
+        counts.update((r["root_id"], r["count"]) for r in rows)
+        return counts
+
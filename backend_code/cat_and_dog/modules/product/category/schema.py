@@ -1,11 +1,12 @@
 from marshmallow.fields import *
 
-from cat_and_dog.utils.errors.exceptions import SchemaException
+from cat_and_dog.utils.errors.exceptions import SchemaException, TREE_TOO_DEEP
 from cat_and_dog.modules.product.goods.models import Spu
 from cat_and_dog.utils.async_schema.process import async_post_load, async_validates_schema
 from .models import Categories
 from ... import BaseSchema
-from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn
+from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn, BulkMixIn, ExportMixIn, \
+    MixInBase
 from ....utils.empty import Empty
 
 
@@ -18,21 +19,47 @@ class CateBase(BaseSchema):
     parent_id = Integer(load_only=True, query="eq")
 
 
-class CateListSchema(ListMixin, CateBase):
+class CateListBase(CateBase):
+    """列表和导出共用的字段"""
+
+    class Meta(BaseSchema.Meta):
+        eager_load = ("parent",)
+
     # dump_only
-    children_nums = Integer(dump_only=True)
+    children_nums = Integer(dump_only=True, annotate="count", model=Categories, fk="parent_id")
+    descendants_nums = Integer(dump_only=True)
+    parent = Nested("CateDetailSchema", only=("id", "name"), dump_only=True)
+
+
+class SubtreeCountMixIn(MixInBase):
+    """`descendants_nums`: 所有子孙分类的数量, 整页只执行一次递归查询(见`Categories.subtree_counts`)"""
+
+    async def annotate(self, instances: list):
+        await super().annotate(instances)
+        if "descendants_nums" not in self.dump_field_name:
+            return
+
+        counts = await Categories.subtree_counts({i.id for i in instances})
+        for i in instances:
+            i.descendants_nums = counts[i.id]
+
+
+class CateListSchema(SubtreeCountMixIn, ListMixin, CateListBase):
 
     @async_post_load
     async def make_queries(self, data: dict):
         if data.get("parent_id", Empty) is not Empty:
             data["parent_id"] = data["parent_id"] or None
-        # 添加children_nums
-        res = await super().make_queries(data)
-        for r in res:
-            setattr(
-                r, "children_nums", await r.count_child()
-            )
-        return res
+        return await super().make_queries(data)
+
+
+class CateExportSchema(SubtreeCountMixIn, ExportMixIn, CateListBase):
+
+    @async_post_load
+    async def make_export_query(self, data: dict):
+        if data.get("parent_id", Empty) is not Empty:
+            data["parent_id"] = data["parent_id"] or None
+        return await super().make_export_query(data)
 
 
 class CateCountSchema(CountMixIn, CateBase):
@@ -44,6 +71,42 @@ class CateCountSchema(CountMixIn, CateBase):
         return await super().count(data)
 
 
+class CateBulkSchema(BulkMixIn, CateBase):
+    """
+    批量创建/更新分类, 有id时更新, 没有时创建
+
+    写入之前整批检查循环引用, 包括同一批数据之间形成的循环(如A->B, B->A)
+    """
+    id = Integer(key_check=True, model=Categories)
+    parent_id = Integer(load_only=True, key_check=True, model=Categories)
+
+    name = String(required=True)
+
+    @async_validates_schema(pass_many=True)
+    async def check_circular_reference(self, data, many):
+        """将数据库中的parent与本批数据修改之后的parent合并, 从每个修改的分类向上查找"""
+        rows = data if many else [data]
+        moved = {row["id"]: row["parent_id"] for row in rows if row.get("id") and "parent_id" in row}
+        if not moved:
+            return
+        if any(pk == parent_id for pk, parent_id in moved.items()):
+            raise SchemaException("无法将子类设置为自己")
+
+        parents = await Categories.parent_map(set(moved) | {p for p in moved.values() if p})
+        parents.update(moved)
+
+        for pk in moved:
+            path = {pk}
+            node = parents.get(pk)
+            while node is not None:
+                if node in path:
+                    raise SchemaException("无法将已有子类设置为父类")
+                if len(path) > Categories.TREE_MAX_DEPTH:
+                    raise TREE_TOO_DEEP
+                path.add(node)
+                node = parents.get(node)
+
+
 class CateDetailSchema(DetailMixIn, CateBase):
     # load_only
     id = Integer(key_check=True, model=Categories)
@@ -80,12 +143,35 @@ class CateDetailSchema(DetailMixIn, CateBase):
     @staticmethod
     async def check_parent(this_instance, parent_instance):
         """
-        检查是否存在循环引用的情况
+        检查是否存在循环引用的情况, 递归查询一次取出`parent_instance`的所有祖先
         :param this_instance: 需要更新的模型对象
         :param parent_instance: `this_instance` 即将设置的parent_instance
         :return:
         """
-        while await parent_instance.parent:
-            parent_instance = await parent_instance.parent
-            if parent_instance.id == this_instance.id:
-                raise SchemaException("无法将已有子类设置为父类")
+        if this_instance.id in await Categories.ancestors(parent_instance.id):
+            raise SchemaException("无法将已有子类设置为父类")
+
+
+class CateTreeSchema(CateBase):
+    """分类树"""
+    # load_only
+    root = Integer(load_only=True)
+
+    # dump_only
+    children = Nested("self", many=True, dump_only=True)
+
+    @async_post_load
+    async def make_tree(self, data: dict):
+        """一次查询取出整棵树, 返回根节点的列表"""
+        root = data.get("root")
+        nodes = await Categories.descendants(root)
+
+        children = dict()
+        for node in nodes:
+            children.setdefault(node.parent_id, []).append(node)
+        for node in nodes:
+            node.children.children = children.get(node.id, [])
+
+        if root is None:
+            return children.get(None, [])
+        return [node for node in nodes if node.id == root]
@@ -1,25 +1,30 @@
-from sanic.response import json
+from functools import partial
+
+from sanic.response import stream
 from sanic.views import HTTPMethodView
 
 from cat_and_dog import db
+from cat_and_dog.modules import detail_cache
 from cat_and_dog.utils.errors.status_code import UPDATE_OK
 from cat_and_dog.utils.login.tools import admin_required
+from cat_and_dog.utils.request.response import json, conditional_json
 from .models import Spu as ModelSpu, Sku as ModelSku
-from .schema import SpuCountSchema, SpuDetailSchema, SpuListSchema, SkuListSchema, SkuCountSchema, SkuDetailSchema
+from .schema import SpuCountSchema, SpuDetailSchema, SpuListSchema, SkuListSchema, SkuCountSchema, SkuDetailSchema, \
+    SpuBulkSchema, SkuBulkSchema, SpuExportSchema, SkuExportSchema
 
 
 class Spus(HTTPMethodView):
     async def get(self, request):
         """获取SPU列表"""
-        schema = SpuListSchema(strict=True)
+        schema = SpuListSchema.shared(strict=True)
         instance_list, error = await schema.async_load(request.single_args)
         data, error = await schema.async_dump(instance_list, many=True)
-        return json(data)
+        return conditional_json(request, data, **instance_list.meta)
 
     @admin_required
     async def post(self, request):
         """创建SPU"""
-        schema = SpuDetailSchema(strict=True)
+        schema = SpuDetailSchema.shared(strict=True)
         instance = (await schema.async_load(request.json)).data
         data, error = await schema.async_dump(instance)
         return json(data)
@@ -28,24 +33,27 @@ class Spus(HTTPMethodView):
 class Spu(HTTPMethodView):
     async def get(self, request, pk: int):
         """获取SPU详情"""
-        schema = SpuDetailSchema()
-        instance = await ModelSpu.get_or_404(pk)
-        data, error = await schema.async_dump(instance)
-        return json(data)
+        schema = SpuDetailSchema.shared()
+        entry = await detail_cache.get_entry(ModelSpu, pk, schema)
+        return conditional_json(request, entry["data"], entry["etag"], entry["last_modified"])
 
     @admin_required
     async def delete(self, request, pk: int):
         """删除SPU"""
+        stale = set()
         async with db.auto_commit():
-            # await ModelCategories.get(pk)
+            instance = await ModelSpu.get_for_update(pk)
+            if instance:
+                stale = await detail_cache.related(instance)
             res = await ModelSpu.delete.where(ModelSpu.id == pk).gino.status()
 
+        await detail_cache.invalidate(stale)
         return json({"res": res[0]})
 
     @admin_required
     async def put(self, request, pk: int):
         """更新SPU"""
-        schema = SpuDetailSchema(strict=True, partial=True)
+        schema = SpuDetailSchema.shared(strict=True, partial=True)
         data = request.json
         data['id'] = pk
         instance = (await schema.async_load(data)).data
@@ -55,24 +63,24 @@ class Spu(HTTPMethodView):
 
 class SpusCount(HTTPMethodView):
     async def get(self, request):
-        schema = SpuCountSchema(strict=True)
+        schema = SpuCountSchema.shared(strict=True)
         count, error = await schema.async_load(request.single_args)
-        return json({"count": count})
+        return json(count)
 
 
 class Skus(HTTPMethodView):
     async def get(self, request):
         """获取Sku列表"""
         # breakpoint()
-        schema = SkuListSchema(strict=True)
+        schema = SkuListSchema.shared(strict=True)
         instance_list, error = await schema.async_load(request.single_args)
         data, error = await schema.async_dump(instance_list, many=True)
-        return json(data)
+        return conditional_json(request, data, **instance_list.meta)
 
     @admin_required
     async def post(self, request):
         """创建Sku"""
-        schema = SkuDetailSchema()
+        schema = SkuDetailSchema.shared()
         instance, error = await schema.async_load(request.single_args)
         data, error = await schema.async_load(instance)
         return json(data)
@@ -81,10 +89,9 @@ class Skus(HTTPMethodView):
 class Sku(HTTPMethodView):
     async def get(self, request, pk: int):
         """SKU详情"""
-        schema = SkuDetailSchema()
-        instance = await ModelSku.get_or_404(pk)
-        data, error = await schema.async_dump(instance)
-        return json(data)
+        schema = SkuDetailSchema.shared()
+        entry = await detail_cache.get_entry(ModelSku, pk, schema)
+        return conditional_json(request, entry["data"], entry["etag"], entry["last_modified"])
 
     @admin_required
     async def put(self, request):
@@ -92,13 +99,55 @@ class Sku(HTTPMethodView):
 
     @admin_required
     async def delete(self, request, pk: int):
+        stale = set()
         async with db.auto_commit():
-            res = await ModelSku.delete.where(ModelSpu.id == pk).gino.status()
+            instance = await ModelSku.get_for_update(pk)
+            if instance:
+                stale = await detail_cache.related(instance)
+            res = await ModelSku.delete.where(ModelSku.id == pk).gino.status()
+
+        await detail_cache.invalidate(stale)
         return json({"res": res[0]})
 
 
 class SkusCount(HTTPMethodView):
     async def get(self, request):
-        schema = SkuCountSchema(strict=True)
+        schema = SkuCountSchema.shared(strict=True)
         count, error = await schema.async_load(request.single_args)
-        return json({"count": count})
+        return json(count)
+
+
+class SpusBulk(HTTPMethodView):
+    @admin_required
+    async def post(self, request):
+        """批量创建/更新Spu, 接受JSON数组或者NDJSON"""
+        schema = SpuBulkSchema.shared(strict=True, many=True)
+        result, error = await schema.async_load(request.json_rows)
+        return json(result, status=UPDATE_OK)
+
+
+class SkusBulk(HTTPMethodView):
+    @admin_required
+    async def post(self, request):
+        """批量创建/更新Sku, 以code区分, 接受JSON数组或者NDJSON"""
+        schema = SkuBulkSchema.shared(strict=True, many=True)
+        result, error = await schema.async_load(request.json_rows)
+        return json(result, status=UPDATE_OK)
+
+
+class SpusExport(HTTPMethodView):
+    @admin_required
+    async def get(self, request):
+        """导出Spu, 返回NDJSON"""
+        schema = SpuExportSchema.shared(strict=True)
+        query, error = await schema.async_load(request.single_args)
+        return stream(partial(schema.export, query), content_type="application/x-ndjson")
+
+
+class SkusExport(HTTPMethodView):
+    @admin_required
+    async def get(self, request):
+        """导出Sku, 返回NDJSON"""
+        schema = SkuExportSchema.shared(strict=True)
+        query, error = await schema.async_load(request.single_args)
+        return stream(partial(schema.export, query), content_type="application/x-ndjson")
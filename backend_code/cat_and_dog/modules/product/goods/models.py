@@ -2,7 +2,7 @@
 
 from sqlalchemy import *
 
-from cat_and_dog.modules import RecordingMixin, Base
+from cat_and_dog.modules import RecordingMixin, Base, trgm_index
 from cat_and_dog.utils.relations.orm_relations import one2many, many2one
 
 
@@ -11,6 +11,8 @@ class Spu(RecordingMixin, Base):
     iPhone6
     """
     __tablename__ = "spu"
+    # `Index("ix_spu_create_time_id")`用于游标分页, 见`SpuListSchema.__sort_key__`
+    __table_args__ = (trgm_index("spu", "name"), Index("ix_spu_create_time_id", "create_time", "id"))
 
     name = Column(String(255), nullable=False, index=True)
     category_id = Column(Integer, ForeignKey("categories.id", ondelete="SET NULL"), nullable=True, index=True)
@@ -31,6 +33,9 @@ class Sku(RecordingMixin, Base):
     iPhone 6 16g 红色 xx
     """
     __tablename__ = "sku"
+    # `Index("ix_sku_create_time_id")`用于游标分页, 见`SkuListSchema.__sort_key__`
+    __table_args__ = (trgm_index("sku", "name"), trgm_index("sku", "code"),
+                      Index("ix_sku_create_time_id", "create_time", "id"))
 
     name = Column(String(255), nullable=False, index=True)
     code = Column(String(30), index=True, nullable=False, unique=True)
@@ -1,7 +1,8 @@
 from marshmallow import fields
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, func
 
-from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn, PreLoadListMixin
+from cat_and_dog.utils.async_schema.mixins import ListMixin, DetailMixIn, CountMixIn, PreLoadListMixin, MixInBase, \
+    BulkMixIn, ExportMixIn
 from .models import Spu, Sku, ProductSpecificationOptions
 from ..brand.models import Brand
 from ..category.models import Categories
@@ -15,7 +16,24 @@ class SpuBase(BaseSchema):
     brand_id = fields.List(fields.Integer(), load_only=True, query="eq")
 
 
-class SpuListSchema(PreLoadListMixin, ListMixin, SpuBase):
+class SpuListBase(SpuBase):
+    """列表和导出共用的字段"""
+
+    class Meta(BaseSchema.Meta):
+        eager_load = ("category", "brand")
+
+    # dump_only
+    category = fields.Nested("CateDetailSchema", only=("id", "name"), dump_only=True)
+    brand = fields.Nested("BrandDetailSchema", only=("id", "name"), dump_only=True)
+    skus_nums = fields.Integer(dump_only=True, annotate="count", model=Sku, fk="spu_id")
+
+
+class SpuListSchema(PreLoadListMixin, ListMixin, SpuListBase):
+    # 游标分页按照创建时间翻页
+    __sort_key__ = "create_time"
+
+
+class SpuExportSchema(PreLoadListMixin, ExportMixIn, SpuListBase):
     pass
 
 
@@ -55,33 +73,68 @@ class SpuDetailSchema(DetailMixIn, SpuBase):
     brand = fields.Nested("BrandDetailSchema", only=("id", "name"), dump_only=True)
 
 
+class SpuBulkSchema(BulkMixIn, SpuBase):
+    # 有id时更新, 没有时创建
+    id = fields.Integer(key_check=True,
+                        model=Spu)
+    category_id = fields.Integer(load_only=True,
+                                 key_check=True,
+                                 model=Categories)
+    brand_id = fields.Integer(load_only=True,
+                              key_check=True,
+                              model=Brand)
+
+    name = fields.String(required=True)
+    information = fields.String()
+
+
 class SkuBase(BaseSchema):
     __model__ = Sku
     name = fields.String(query="like")
     spu_id = fields.List(fields.Integer(), load_only=True, query="eq")
 
 
-class SkuListMixin(ListMixin):
+class SkuQueryMixin(MixInBase):
     def fields_to_queries(self, field_value):
         """使得获取列表时name可以和code混合查询"""
         copy_value = field_value.copy()
         ext_query = True
         name_field = self.fields["name"]
         if name_field in field_value:
-            value = field_value[name_field]
-            ext_query = or_(self.__model__.code.like(f"%{value}%"), self.__model__.name.like(f"%{value}%"))
+            pattern = self.like_pattern(field_value[name_field])
+            ext_query = or_(self.__model__.code.like(pattern, escape="\\"),
+                            self.__model__.name.like(pattern, escape="\\"))
             copy_value.pop(name_field)
 
         queries = super().fields_to_queries(copy_value)
 
         return and_(queries, ext_query)
 
+    def search_ranks(self, field_value):
+        copy_value = field_value.copy()
+        ranks = list()
+        name_field = self.fields["name"]
+        if name_field in field_value:
+            value = copy_value.pop(name_field)
+            ranks.append(func.greatest(func.similarity(self.__model__.code, value),
+                                       func.similarity(self.__model__.name, value)))
+        return super().search_ranks(copy_value) + ranks
+
+
+class SkuListMixin(SkuQueryMixin, ListMixin):
+    pass
+
 
 class SkuListSchema(PreLoadListMixin, SkuListMixin, SkuBase):
+    # 游标分页按照创建时间翻页
+    __sort_key__ = "create_time"
+
+
+class SkuCountSchema(PreLoadListMixin, SkuQueryMixin, CountMixIn, SkuBase):
     pass
 
 
-class SkuCountSchema(PreLoadListMixin, SkuListMixin, SkuBase):
+class SkuExportSchema(PreLoadListMixin, SkuQueryMixin, ExportMixIn, SkuBase):
     pass
 
 
@@ -99,3 +152,17 @@ class SkuDetailSchema(DetailMixIn, SkuBase):
                             model=Spu)
 
     spu = fields.Nested("SpuDetailSchema", dump_only=True)
+
+
+class SkuBulkSchema(BulkMixIn, SkuBase):
+    __conflict_key__ = "code"
+
+    id = fields.Integer(dump_only=True)
+    name = fields.Str(required=True)
+    code = fields.Str(required=True)
+    price = fields.Float(required=True)
+    purchase_price = fields.Float(required=True)
+
+    spu_id = fields.Integer(load_only=True,
+                            key_check=True,
+                            model=Spu)
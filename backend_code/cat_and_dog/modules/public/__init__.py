@@ -7,4 +7,4 @@ from ..api_version import api_prefix
 public_bp = Blueprint("public", url_prefix=api_prefix)
 
 
-from . import upload
+from . import upload, stats
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import os
+
+from cat_and_dog.modules import db, detail_cache, user_cache, password_hasher
+from cat_and_dog.utils.async_schema.mixins import statement_cache
+from cat_and_dog.utils.login.tools import admin_required
+from cat_and_dog.utils.request.compress import compress
+from cat_and_dog.utils.request.response import json
+from . import public_bp
+
+
+@public_bp.get("stats")
+@admin_required
+async def stats(request):
+    """当前worker的运行指标"""
+    return json({
+        "pid": os.getpid(),
+        "cache": detail_cache.stats(),
+        "users": user_cache.stats(),
+        "password_hash": password_hasher.stats(),
+        "compress": compress.stats(),
+        "pool": db.pool_stats(),
+        # 按照查询结构复用的语句, 以及这些语句在sqlalchemy中的编译缓存
+        "statements": {**statement_cache.stats(), "hit_rate": statement_cache.hit_rate()},
+        "compiled": {**db.compiled_cache.stats(), "hit_rate": db.compiled_cache.hit_rate()},
+    })
@@ -3,7 +3,7 @@ import os
 
 import aiofiles
 from sanic.exceptions import abort
-from sanic.response import json
+from cat_and_dog.utils.request.response import json
 
 from cat_and_dog.utils.login.tools import admin_required
 from . import public_bp
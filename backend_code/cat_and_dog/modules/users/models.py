@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from functools import partial
 
+from gino.crud import UpdateRequest
 from sqlalchemy import *
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.security import generate_password_hash
 
+from cat_and_dog.utils.errors.exceptions import ApiException
 from cat_and_dog.utils.login.mixins import UserMixin
 from cat_and_dog.utils.relations.orm_relations import many2one
-from .. import RecordingMixin, Base, db
+from .. import RecordingMixin, Base, db, user_cache, password_hasher
 
 
 class WeiXinUser(RecordingMixin, Base):
@@ -27,9 +30,19 @@ class WeiXinUser(RecordingMixin, Base):
     # user = relationship("User", backref="weixin", uselist=False)
 
 
+class UserUpdateRequest(UpdateRequest):
+    """修改用户的事务提交之后使登录用户的缓存失效"""
+
+    async def apply(self, *args, **kwargs):
+        result = await super().apply(*args, **kwargs)
+        await db.after_commit(partial(user_cache.invalidate, type(self._instance), self._instance.id))
+        return result
+
+
 class User(UserMixin, RecordingMixin, Base):
     """User, 核心表"""
     __tablename__ = "user"
+    _update_request_cls = UserUpdateRequest
 
     # id = Column(Integer, primary_key=True)
     nick_name = Column(String(32), nullable=False)  # 用户昵称
@@ -48,18 +61,35 @@ class User(UserMixin, RecordingMixin, Base):
     def is_active(self):
         return self.status == 1
 
+    async def delete(self, *args, **kwargs):
+        result = await super().delete(*args, **kwargs)
+        await db.after_commit(partial(user_cache.invalidate, type(self), self.id))
+        return result
+
     @property
     def password(self):
         return None
 
     @password.setter
     def password(self, value):
-        self.password_hash = generate_password_hash(value)
+        """会阻塞event loop, 只在脚本中使用, 请求中使用`set_password`"""
+        self.password_hash = generate_password_hash(value, method=password_hasher.method,
+                                                    salt_length=password_hasher.salt_length)
+
+    async def set_password(self, value):
+        self.password_hash = await password_hasher.hash(value)
 
     async def check_pwd(self, pwd):
-        """验证密码的同时更新最后登录时间"""
-        is_success = check_password_hash(self.password_hash, pwd)
+        """验证密码的同时更新最后登录时间, 旧的method计算的hash在登录成功时使用当前的method重新计算"""
+        is_success = await password_hasher.check(self.password_hash, pwd)
         if is_success:
+            values = dict(last_login=datetime.now())
+            if password_hasher.needs_rehash(self.password_hash):
+                try:
+                    values["password_hash"] = await password_hasher.hash(pwd)
+                except ApiException:
+                    # 计算hash的队列已满时不影响登录, 下次登录时再重新计算
+                    pass
             async with db.auto_commit():
-                await self.update(last_login=datetime.now()).apply()
+                await self.update(**values).apply()
         return is_success
@@ -1,8 +1,23 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import time
+from types import SimpleNamespace
+
+import aioredis
 import pytest
+import ujson
+from sanic.response import HTTPResponse
 from sanic.websocket import WebSocketProtocol
+from werkzeug.security import check_password_hash, generate_password_hash
 
 from cat_and_dog import create_app
+from cat_and_dog.modules import password_hasher
+from cat_and_dog.modules.users.models import User
+from cat_and_dog.test.test_for_cache import FakeTransactionConnection
+from cat_and_dog.utils.errors.exceptions import ApiException, TOO_MANY_LOGINS
+from cat_and_dog.utils.login.hashing import PasswordHasher
+from cat_and_dog.utils.login.session import SignedSessionInterface
+from cat_and_dog.utils.routing import use_connection
 
 
 @pytest.yield_fixture
@@ -32,3 +47,203 @@ async def test_fixture_test_client_get(test_cli):
     """
     resp = await test_cli.get('/')
     assert resp.status == 200
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = dict()
+        self.published = list()
+
+    async def set(self, key, value, expire=None):
+        self.data[key] = str(value).encode()
+
+    async def mget(self, *keys):
+        return [self.data.get(key.decode()) for key in keys]
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def iscan(self, match):
+        async def scan():
+            for key in list(self.data):
+                if key.startswith(match.rstrip("*")):
+                    yield key.encode()
+        return scan()
+
+
+class FakeSubscriber:
+    """订阅的连接以及channel"""
+
+    def __init__(self, *messages):
+        self.messages = asyncio.Queue()
+        for message in messages:
+            self.messages.put_nowait(message)
+
+    async def subscribe(self, channel):
+        return [self]
+
+    async def iter(self, encoding=None):
+        while True:
+            yield await self.messages.get()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeRequest:
+    def __init__(self, token=None):
+        self.cookies = {"session": token} if token else dict()
+        self.headers = dict()
+        self.ctx = SimpleNamespace()
+
+
+def make_interface(**kwargs):
+    return SignedSessionInterface(FakeRedis(), keys=["new-key", "old-key"], **kwargs)
+
+
+def test_signed_token_tampering():
+    interface = make_interface()
+    exp = int(time.time()) + 60
+    token = interface.dumps({"user_id": 1, "sid": "a", "exp": exp})
+    payload, kid, signature = token.rsplit(".", 2)
+
+    assert interface.loads(token) == ({"user_id": 1, "sid": "a", "exp": exp}, False)
+
+    forged = interface.dumps({"user_id": 2, "sid": "a", "exp": exp}).split(".")[0]
+    assert interface.loads(f"{forged}.{kid}.{signature}") == (None, False)
+    assert interface.loads(f"{payload}.{kid}.{signature[:-2]}") == (None, False)
+    assert interface.loads(f"{payload}.unknown.{signature}") == (None, False)
+    assert interface.loads("not a token") == (None, False)
+
+    # 使用旧的密钥签名的token仍然有效, 但是需要重新签名
+    old = SignedSessionInterface(FakeRedis(), keys=["old-key"])
+    data, rotate = interface.loads(old.dumps({"user_id": 1, "sid": "a", "exp": exp}))
+    assert data["user_id"] == 1 and rotate
+
+
+def test_signed_token_expiry():
+    interface = make_interface()
+    assert interface.loads(interface.dumps({"sid": "a", "exp": int(time.time()) - 1})) == (None, False)
+
+
+async def test_logout_revokes_the_token():
+    interface = make_interface()
+    exp = int(time.time()) + 60
+    token = interface.dumps({"user_id": 1, "cart": [1], "sid": "a", "exp": exp})
+
+    request = FakeRequest(token)
+    session = await interface.open(request)
+    assert session["user_id"] == 1 and session.sid == "a"
+
+    # 登出之后session中还有其他数据, 原来的token也不能再使用
+    session.pop("user_id")
+    await interface.revoke_session(session)
+    response = HTTPResponse()
+    await interface.save(request, response)
+
+    assert interface.is_revoked("a")
+    assert interface.redis.data == {"session:revoked:a": str(exp).encode()}
+    assert interface.redis.published == [(interface.channel, ujson.dumps({"sid": "a", "exp": exp}))]
+
+    new_token = response.cookies["session"].value
+    data, _ = interface.loads(new_token)
+    assert data["cart"] == [1] and "user_id" not in data and data["sid"] != "a"
+
+    replayed = await interface.open(FakeRequest(token))
+    assert not replayed and replayed.sid != "a"
+    assert (await interface.open(FakeRequest(new_token)))["cart"] == [1]
+
+
+async def test_revocation_synced_over_pubsub():
+    interface = make_interface()
+    # 订阅之前已经吊销的sid
+    await interface.redis.set(interface.prefix + "old", int(time.time()) + 60)
+    subscriber = FakeSubscriber(ujson.dumps({"sid": "new", "exp": int(time.time()) + 60}))
+
+    create_redis, aioredis.create_redis = aioredis.create_redis, lambda address: _return(subscriber)
+    task = asyncio.get_running_loop().create_task(interface.subscribe("redis://localhost"))
+    try:
+        for _ in range(100):
+            if interface.is_revoked("new"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        aioredis.create_redis = create_redis
+
+    assert interface.is_revoked("old") and interface.is_revoked("new")
+    assert not interface.is_revoked("other")
+
+    # 过期之后从吊销列表中删除
+    interface.revoked["new"] = int(time.time()) - 1
+    assert not interface.is_revoked("new") and "new" not in interface.revoked
+
+
+async def _return(value):
+    return value
+
+
+def test_password_needs_rehash():
+    hasher = PasswordHasher()
+    hasher.method = "scrypt"
+    assert not hasher.needs_rehash("scrypt:32768:8:1$salt$hash")
+    assert hasher.needs_rehash("pbkdf2:sha256:600000$salt$hash")
+
+    # 配置了完整的method时, 参数不同也需要重新计算
+    hasher.method = "pbkdf2:sha256:600000"
+    assert not hasher.needs_rehash("pbkdf2:sha256:600000$salt$hash")
+    assert hasher.needs_rehash("pbkdf2:sha256:260000$salt$hash")
+
+
+async def test_password_hash_queue_is_limited():
+    hasher = PasswordHasher()
+    hasher.concurrency, hasher.max_waiting = 1, 2
+    release = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    async def blocking():
+        return await hasher.run(lambda: asyncio.run_coroutine_threadsafe(release.wait(), loop).result())
+
+    running = [loop.create_task(blocking()) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    assert hasher.stats() == {"concurrency": 1, "waiting": 2}
+    with pytest.raises(ApiException) as e:
+        await hasher.run(lambda: None)
+    assert e.value is TOO_MANY_LOGINS
+
+    release.set()
+    await asyncio.gather(*running)
+    assert hasher.stats()["waiting"] == 0
+
+
+async def test_password_rehashed_on_login():
+    method = password_hasher.method
+    password_hasher.method = "pbkdf2:sha256:1000"
+    old_hash = generate_password_hash("secret", method="pbkdf2:sha256:10")
+    updates = list()
+
+    async def check(user, pwd):
+        user.update = lambda **values: SimpleNamespace(apply=lambda: _return(updates.append(values)))
+        with use_connection(FakeTransactionConnection()):
+            return await user.check_pwd(pwd)
+
+    try:
+        # 密码错误时不更新
+        assert not await check(User(id=1, password_hash=old_hash), "wrong")
+        assert updates == []
+
+        assert await check(User(id=1, password_hash=old_hash), "secret")
+        values, = updates
+        assert set(values) == {"last_login", "password_hash"}
+        assert values["password_hash"].startswith("pbkdf2:sha256:1000$")
+        assert check_password_hash(values["password_hash"], "secret")
+
+        # 已经是当前的method时只更新登录时间
+        updates.clear()
+        assert await check(User(id=1, password_hash=values["password_hash"]), "secret")
+        assert set(updates[0]) == {"last_login"}
+    finally:
+        password_hasher.method = method
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+import ujson
+from gino.crud import UpdateRequest
+from sanic.response import HTTPResponse
+from sqlalchemy import column, select
+from sqlalchemy.dialects import postgresql
+
+from cat_and_dog.modules import db, detail_cache, user_cache
+from cat_and_dog.modules.product.category.models import Categories
+from cat_and_dog.modules.users.models import User
+from cat_and_dog.utils.cache.lru import CompiledCache, LRUCache
+from cat_and_dog.utils.relations.identity_map import IdentityMap
+from cat_and_dog.utils.request.compress import Compress, parse_accept_encoding
+from cat_and_dog.utils.request.response import conditional_json, last_modified_of
+from cat_and_dog.utils.routing import use_connection
+
+
+def test_lru_evict_least_recently_used():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)  # "b" is the least recently used
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_lru_ttl():
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.evictions == 1
+
+
+def test_lru_contains_does_not_count():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.stats() == {"size": 1, "hits": 0, "misses": 0, "evictions": 0}
+
+
+def test_compiled_cache_only_keeps_shaped_statements():
+    cache = CompiledCache(maxsize=2, ttl=float("inf"))
+    adhoc = select([column("id")])
+    shaped = adhoc.execution_options(shaped=True)
+
+    cache[(None, adhoc, (), False)] = "adhoc"
+    cache[(None, shaped, (), False)] = "shaped"
+
+    assert cache.get((None, adhoc, (), False)) is None
+    assert cache.get((None, shaped, (), False)) == "shaped"
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 0, "evictions": 0}
+
+
+async def test_cached_instance_is_shared_within_a_request():
+    async def get_twice():
+        token = IdentityMap().bind()
+        try:
+            return await Categories.get(1), await Categories.get(1)
+        finally:
+            IdentityMap.unbind(token)
+
+    tables, detail_cache.instance_tables = detail_cache.instance_tables, {"categories"}
+    detail_cache.instances.set(detail_cache.key(Categories, 1), {"id": 1, "name": "phone", "parent_id": None})
+    try:
+        a, b = await get_twice()
+        c, _ = await get_twice()
+    finally:
+        detail_cache.instances.clear()
+        detail_cache.instance_tables = tables
+
+    # 同一个请求中是同一个实例, 不同的请求使用各自的副本
+    assert a is b and a.name == "phone"
+    assert c is not a
+
+
+async def test_get_for_update_skips_the_cache():
+    fresh = Categories(id=1, name="fresh")
+
+    class Connection:
+        statement = None
+
+        async def first(self, clause, *multiparams, **params):
+            self.statement = str(clause.compile(dialect=postgresql.dialect()))
+            return fresh
+
+    identity_map = IdentityMap()
+    identity_map.add(Categories(id=1, name="stale"))
+    token = identity_map.bind()
+    conn = Connection()
+    try:
+        with use_connection(conn):
+            assert await Categories.get_for_update(1) is fresh
+    finally:
+        IdentityMap.unbind(token)
+
+    assert conn.statement.endswith("FOR UPDATE")
+    assert identity_map.get(Categories, 1) is None
+
+
+class FakeTransaction:
+    def __init__(self):
+        self.committed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def raise_commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeTransactionConnection:
+    def __init__(self):
+        self.transactions = list()
+
+    def transaction(self):
+        self.transactions.append(FakeTransaction())
+        return self.transactions[-1]
+
+
+async def test_user_cache_invalidated_after_commit():
+    invalidated = list()
+    invalidate, user_cache.invalidate = user_cache.invalidate, lambda *args: _record(invalidated, args)
+    apply, UpdateRequest.apply = UpdateRequest.apply, lambda self: _record([], ())
+    conn = FakeTransactionConnection()
+    try:
+        with use_connection(conn):
+            async with db.auto_commit():
+                await User(id=1).update(nick_name="new").apply()
+                async with db.auto_commit():
+                    await User(id=2).update(nick_name="new").apply()
+                # 提交之前并发的请求仍然可以读到旧的数据并写入缓存, 提交之后才失效
+                assert invalidated == []
+            assert invalidated == [(User, 1), (User, 2)]
+
+            # 回滚时不需要失效
+            invalidated.clear()
+            with pytest.raises(ValueError):
+                async with db.auto_commit():
+                    await User(id=3).update(nick_name="new").apply()
+                    raise ValueError("rollback")
+            assert invalidated == []
+
+        # 不在事务中时立即失效
+        await User(id=4).update(nick_name="new").apply()
+        assert invalidated == [(User, 4)]
+    finally:
+        user_cache.invalidate = invalidate
+        UpdateRequest.apply = apply
+
+
+async def _record(calls: list, args):
+    calls.append(args)
+
+
+class FakeRequest:
+    def __init__(self, **headers):
+        self.headers = {name.replace("_", "-"): value for name, value in headers.items()}
+
+
+def test_list_response_uses_etag_only():
+    rows = [{"id": 1, "update_time": "2020-01-01T12:00:00"}]
+    response = conditional_json(FakeRequest(), rows, next=None)
+    etag = response.headers["ETag"]
+
+    # 删除一行之后最大的update_time不变, 列表不能使用Last-Modified
+    assert "Last-Modified" not in response.headers
+    assert conditional_json(FakeRequest(If_Modified_Since="Fri, 01 Jan 2100 00:00:00 GMT"), rows).status == 200
+    assert conditional_json(FakeRequest(If_None_Match=etag), rows, next=None).status == 304
+    assert conditional_json(FakeRequest(If_None_Match=etag), rows[:0], next=None).status == 200
+
+
+def test_detail_last_modified_in_utc():
+    tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Asia/Shanghai"
+    time.tzset()
+    try:
+        data = {"id": 1, "update_time": "2020-01-01T10:00:00", "parent": {"update_time": "2020-01-01T12:00:00"}}
+        last_modified = last_modified_of(data)
+        response = conditional_json(FakeRequest(), data, "W/\"etag\"", last_modified.isoformat())
+    finally:
+        if tz is None:
+            os.environ.pop("TZ")
+        else:
+            os.environ["TZ"] = tz
+        time.tzset()
+
+    # 本地时间12:00(UTC+8)
+    assert last_modified == datetime(2020, 1, 1, 4, tzinfo=timezone.utc)
+    assert response.headers["Last-Modified"] == "Wed, 01 Jan 2020 04:00:00 GMT"
+
+    def status(**headers):
+        return conditional_json(FakeRequest(**headers), data, "W/\"etag\"", last_modified).status
+
+    assert status(If_Modified_Since="Wed, 01 Jan 2020 04:00:00 GMT") == 304
+    assert status(If_Modified_Since="Wed, 01 Jan 2020 03:59:59 GMT") == 200
+    assert status(If_None_Match="W/\"etag\", \"other\"") == 304
+    # If-None-Match优先于If-Modified-Since
+    assert status(If_None_Match="\"other\"", If_Modified_Since="Wed, 01 Jan 2020 04:00:00 GMT") == 200
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = dict()
+        self.published = list()
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, expire=None):
+        self.data[key] = value
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class FakeModel:
+    __tablename__ = "fake"
+    loads = 0
+
+    @classmethod
+    async def get_or_404(cls, pk):
+        cls.loads += 1
+        return {"id": pk, "update_time": "2020-01-01T00:00:00+00:00"}
+
+
+class FakeDetailSchema:
+    async def async_dump(self, instance):
+        return dict(instance), dict()
+
+
+async def test_detail_cache_read_through_and_invalidate():
+    app, detail_cache.app = detail_cache.app, SimpleNamespace(redis=FakeRedis())
+    redis = detail_cache.redis
+    key = detail_cache.key(FakeModel, 1)
+    schema = FakeDetailSchema()
+    try:
+        entry = await detail_cache.get_entry(FakeModel, 1, schema)
+        assert FakeModel.loads == 1
+        assert entry["data"] == {"id": 1, "update_time": "2020-01-01T00:00:00+00:00"}
+        assert entry["etag"].startswith('W/"') and entry["last_modified"] == "2020-01-01T00:00:00+00:00"
+        assert ujson.loads(redis.data[key]) == entry
+
+        # 进程内缓存以及redis命中时都不会查询数据库
+        assert await detail_cache.get_entry(FakeModel, 1, schema) is entry
+        detail_cache.local.clear()
+        assert await detail_cache.get_entry(FakeModel, 1, schema) == entry
+        assert FakeModel.loads == 1
+
+        # 失效之后所有worker重新加载
+        await detail_cache.invalidate({(FakeModel, 1)})
+        assert key not in redis.data and key not in detail_cache.local
+        assert redis.published == [(detail_cache.channel, ujson.dumps([key]))]
+        await detail_cache.get_entry(FakeModel, 1, schema)
+        assert FakeModel.loads == 2
+    finally:
+        detail_cache.local.clear()
+        detail_cache.app = app
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip, BR;q=0.8, *;q=0") == {"gzip": 1.0, "br": 0.8, "*": 0.0}
+    assert parse_accept_encoding("gzip;q=bad, , identity") == {"gzip": 0.0, "identity": 1.0}
+    assert parse_accept_encoding("") == {}
+
+
+def make_compress(**kwargs) -> Compress:
+    compress = Compress()
+    compress.min_size = 16
+    # 按照优先级排列, 不依赖是否安装了brotli/zstandard
+    compress.compressors = {"br": lambda body: b"br:" + body, "gzip": lambda body: gzip.compress(body, mtime=0)}
+    for name, value in kwargs.items():
+        setattr(compress, name, value)
+    return compress
+
+
+def test_compress_choose_encoding():
+    compress = make_compress()
+    assert compress.choose("gzip, br") == "br"
+    assert compress.choose("gzip, br;q=0.5") == "gzip"
+    assert compress.choose("br;q=0, gzip") == "gzip"
+    assert compress.choose("*") == "br"
+    assert compress.choose("*;q=0.5, gzip") == "gzip"
+    # 不接受任何支持的编码时不压缩
+    assert compress.choose("deflate, *;q=0") is None
+    assert compress.choose("gzip;q=0, br;q=0") is None
+    assert compress.choose("") is None
+
+
+def test_should_compress():
+    compress = make_compress()
+    body = "x" * 16
+    assert compress.should_compress(HTTPResponse(body, content_type="application/json"))
+    assert compress.should_compress(HTTPResponse(body, content_type="text/plain; charset=utf-8"))
+    assert not compress.should_compress(HTTPResponse(body[:-1], content_type="application/json"))
+    assert not compress.should_compress(HTTPResponse(body, content_type="image/png"))
+    assert not compress.should_compress(HTTPResponse(body, status=304, content_type="application/json"))
+    assert not compress.should_compress(HTTPResponse(body, content_type="application/json",
+                                                     headers={"Content-Encoding": "gzip"}))
+
+
+async def test_compress_response_vary_and_encoding():
+    compress = make_compress()
+    body = b'{"a": "' + b"x" * 64 + b'"}'
+
+    response = HTTPResponse(body, content_type="application/json", headers={"Vary": "Origin"})
+    await compress.compress_response(FakeRequest(Accept_Encoding="gzip"), response)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Origin, Accept-Encoding"
+    assert gzip.decompress(response.body) == body
+
+    # 不压缩时也需要Vary, 避免共享缓存将未压缩的响应返回给支持压缩的客户端
+    response = HTTPResponse(body, content_type="application/json")
+    await compress.compress_response(FakeRequest(), response)
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.body == body
+
+
+async def test_compressed_body_cached_by_etag():
+    calls = list()
+    compress = make_compress()
+    compress.compressors = {"gzip": lambda body: calls.append(body) or b"compressed"}
+    body = b"x" * 64
+
+    for _ in range(2):
+        response = HTTPResponse(body, content_type="application/json", headers={"ETag": '"v1"'})
+        await compress.compress_response(FakeRequest(Accept_Encoding="gzip"), response)
+        assert response.body == b"compressed"
+    assert len(calls) == 1
+
+    # 没有ETag的响应不缓存
+    for _ in range(2):
+        response = HTTPResponse(body, content_type="application/json")
+        await compress.compress_response(FakeRequest(Accept_Encoding="gzip"), response)
+    assert len(calls) == 3
@@ -3,9 +3,11 @@
 import uvloop
 from asyncpg import connect
 from gino import Gino
+from gino.loader import ModelLoader
 from sqlalchemy import *
 
-from cat_and_dog.utils.relations.orm_relations import one2many, setup_base, many2one, many2many
+from cat_and_dog.utils.relations.identity_map import IdentityMap
+from cat_and_dog.utils.relations.orm_relations import one2many, setup_base, many2one, many2many, prefetch_relations
 
 DATABASE_URL = "postgresql://localhost/test_for_relation"
 
@@ -125,3 +127,58 @@ async def test_wait_one_relation():
     print("The name of no1's parent is ", no1.parent.name)
 
     assert isinstance(parent.children.children, list)
+
+
+async def test_prefetch_relations():
+    await connect_with_gino()
+    parents = await Parent.query.where(Parent.name == "parent1").gino.all()
+
+    await prefetch_relations(parents, ("children", "favorites"))
+
+    parent = parents[0]
+    assert len(parent.children.children) == 10
+    assert isinstance(parent.favorites[0], ParentFavorite)
+
+    children = parent.children.children
+    await prefetch_relations(children, ("parent",))
+
+    assert all(c.parent.id == parent.id for c in children)
+
+
+async def test_identity_map():
+    await connect_with_gino()
+    token = IdentityMap().bind()
+    try:
+        parent = await Parent.query.where(Parent.name == "parent1").gino.first()
+        assert await Parent.get(parent.id) is parent
+
+        await parent.children
+        no1 = parent.children[0]
+        assert await no1.parent is parent
+    finally:
+        IdentityMap.unbind(token)
+
+
+def test_identity_map_in_one_request():
+    """不需要数据库: 同一个请求中相同`(model, id)`的行只实例化一次, 不同的请求互不影响"""
+    loader = ModelLoader(Parent)
+
+    def load(name):
+        return loader._do_load({Parent.id: 1, Parent.name: name})
+
+    token = IdentityMap().bind()
+    try:
+        first = load("parent1")
+        assert load("parent1 again") is first
+        assert first.name == "parent1"
+    finally:
+        IdentityMap.unbind(token)
+
+    token = IdentityMap().bind()
+    try:
+        assert load("parent1") is not first
+    finally:
+        IdentityMap.unbind(token)
+
+    # 没有绑定identity map时每次都是新的实例
+    assert load("parent1") is not load("parent1")
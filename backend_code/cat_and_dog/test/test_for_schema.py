@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from base64 import urlsafe_b64encode
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+import ujson
+from sqlalchemy.dialects import postgresql
+
+from cat_and_dog.modules import BaseSchema, db
+from cat_and_dog.modules.product.category.models import Categories
+from cat_and_dog.modules.product.brand.models import Brand
+from cat_and_dog.modules.product.brand.schema import BrandBulkSchema, BrandExportSchema
+from cat_and_dog.modules.product.category.schema import CateBulkSchema, CateListSchema
+from cat_and_dog.modules.product.goods.models import Spu
+from cat_and_dog.modules.product.goods.schema import SpuCountSchema, SpuListSchema
+from cat_and_dog.utils.errors.exceptions import SchemaException, TREE_TOO_DEEP
+from cat_and_dog.utils.routing import use_connection
+
+
+class FakeEngine:
+    """每次acquire返回一个新的连接"""
+
+    def __init__(self):
+        self.acquired = list()
+
+    @asynccontextmanager
+    async def acquire(self, reuse=True, reusable=True):
+        assert not reuse and not reusable
+        connection = object()
+        self.acquired.append(connection)
+        yield connection
+
+
+class FakeConnection:
+    """按顺序返回预先给出的结果, 并记录执行的SQL"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = list()
+
+    dialect = postgresql.dialect()
+
+    async def _execute(self, clause, *multiparams, **params):
+        if not isinstance(clause, str):
+            clause = str(clause.compile(dialect=self.dialect))
+        self.statements.append(clause)
+        return self.results.pop(0)
+
+    all = first = scalar = status = _execute
+
+    def compile(self, clause):
+        compiled = clause.compile(dialect=self.dialect)
+        return str(compiled), list(compiled.params.values())
+
+
+class ConcurrentSchema(BaseSchema):
+    """只读的validator才能开启`Meta.concurrency`"""
+
+    class Meta(BaseSchema.Meta):
+        concurrency = True
+
+
+async def test_concurrent_items_use_isolated_connections():
+    engine = FakeEngine()
+    db.bind = engine
+    try:
+        schema = ConcurrentSchema()
+        limit = schema.concurrency_limit()
+        assert limit == db.pool_max_size - 1
+
+        running = 0
+        peak = 0
+        used = list()
+
+        async def validate_item(idx):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            used.append(db.bind)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return idx
+
+        assert await schema._async_map(validate_item, list(range(20))) == list(range(20))
+
+        assert 1 < peak <= limit
+        # 每一项都在自己的连接上执行, 父任务的bind不受影响
+        assert sorted(map(id, used)) == sorted(map(id, engine.acquired))
+        assert len(set(map(id, used))) == 20
+        assert db.bind is engine
+    finally:
+        db.bind = None
+
+
+def test_cursor_after_null_sort_key():
+    schema = SpuListSchema()
+
+    def condition(instance):
+        values = schema.decode_cursor(schema.encode_cursor(instance))
+        return str(schema.cursor_condition(values).compile(dialect=postgresql.dialect()))
+
+    # 排序字段不为NULL时, 之后还有排序字段为NULL的行
+    assert condition(Spu(id=5, create_time=datetime(2020, 1, 1))) == \
+        "(spu.create_time, spu.id) > (%(param_1)s, %(param_2)s) OR spu.create_time IS NULL"
+    # 排序字段为NULL时只剩下NULL的行
+    assert condition(Spu(id=5, create_time=None)) == "spu.create_time IS NULL AND spu.id > %(id_1)s"
+    assert [str(column) for column in schema.order_columns()] == ["spu.create_time ASC NULLS LAST", "spu.id"]
+
+
+def test_ranked_list_has_no_next_cursor():
+    schema = SpuListSchema()
+    order_by, ranked = schema.list_order({"name": "phone", "limit": 2, "offset": 0})
+
+    # 按照相关度排序时after之后的顺序不同, 不能继续使用游标翻页
+    assert ranked and len(order_by) == 3
+    assert schema.next_cursor([Spu(id=1), Spu(id=2)], 2, ranked) is None
+
+
+def test_unranked_list_next_cursor():
+    schema = SpuListSchema()
+    instances = [Spu(id=1, create_time=datetime(2020, 1, 1)), Spu(id=2, create_time=datetime(2020, 1, 2))]
+
+    # 带有after时like查询不再按照相关度排序
+    order_by, ranked = schema.list_order({"name": "phone", "after": "cursor", "limit": 2})
+    assert not ranked and len(order_by) == 2
+
+    order_by, ranked = schema.list_order({"limit": 2, "offset": 0})
+    assert not ranked
+    assert schema.decode_cursor(schema.next_cursor(instances, 2, ranked)) == [datetime(2020, 1, 2), 2]
+    # 最后一页
+    assert schema.next_cursor(instances, 3, ranked) is None
+
+
+def test_forged_cursor_is_rejected():
+
+    schema = SpuListSchema()
+
+    def cursor(values):
+        return urlsafe_b64encode(ujson.dumps(values).encode()).decode()
+
+    for values in (["2020-01-01T00:00:00", "abc"], ["2020-01-01T00:00:00", True], [1, 2],
+                   ["not a time", 2], ["2020-01-01T00:00:00", None], ["2020-01-01T00:00:00"]):
+        with pytest.raises(SchemaException):
+            schema.decode_cursor(cursor(values))
+    with pytest.raises(SchemaException):
+        schema.decode_cursor("not base64!")
+
+    assert schema.decode_cursor(cursor([None, 2])) == [None, 2]
+
+
+
+async def test_subtree_counts_in_one_query():
+    conn = FakeConnection([{"root_id": 1, "count": 3, "depth": 2}])
+    with use_connection(conn):
+        counts = await Categories.subtree_counts({1, 2})
+
+    assert counts == {1: 3, 2: 0}
+    statement, = conn.statements
+    assert statement.startswith("WITH RECURSIVE tree")
+    assert "NOT tree.is_cycle" in statement and "GROUP BY tree.root_id" in statement
+
+
+async def test_subtree_counts_too_deep():
+    conn = FakeConnection([{"root_id": 1, "count": 70, "depth": Categories.TREE_MAX_DEPTH + 1}])
+    with use_connection(conn), pytest.raises(type(TREE_TOO_DEEP)):
+        await Categories.subtree_counts([1])
+
+
+async def test_category_list_descendants_nums():
+    schema = CateListSchema()
+    instances = [Categories(id=1), Categories(id=2)]
+    conn = FakeConnection([(1, 1)], [{"root_id": 1, "count": 3, "depth": 2}])
+    with use_connection(conn):
+        await schema.annotate(instances)
+
+    assert [(i.children_nums, i.descendants_nums) for i in instances] == [(1, 3), (0, 0)]
+    assert len(conn.statements) == 2
+
+
+def test_tree_cte_stops_at_cycles():
+    tree = Categories.tree_cte(Categories.id == 1, up=True)
+    statement = str(db.select([tree.c.id]).compile(dialect=postgresql.dialect()))
+
+    assert statement.startswith("WITH RECURSIVE tree")
+    # 回到path中已有的分类时标记为循环, 并且不再继续递归
+    assert "categories_1.id = ANY (tree.path) AS is_cycle" in statement
+    assert "NOT tree.is_cycle" in statement
+    assert "categories_1.id = tree.parent_id" in statement
+
+
+async def test_ancestors_skip_cycles_and_check_depth():
+    conn = FakeConnection([{"id": 2, "depth": 1}, {"id": 3, "depth": 2}])
+    with use_connection(conn):
+        assert await Categories.ancestors(1) == [2, 3]
+    assert "NOT tree.is_cycle" in conn.statements[0]
+
+    # 超过深度限制时抛出异常, 不会返回截断的结果
+    conn = FakeConnection([{"id": 2, "depth": Categories.TREE_MAX_DEPTH + 1}])
+    with use_connection(conn), pytest.raises(type(TREE_TOO_DEEP)):
+        await Categories.ancestors(1)
+
+
+async def test_annotate_one_query_per_field():
+    schema = SpuListSchema()
+    instances = [Spu(id=1), Spu(id=2), Spu(id=3)]
+    conn = FakeConnection([(1, 2), (3, 1)])
+    with use_connection(conn):
+        await schema.annotate(instances)
+
+    assert [i.skus_nums for i in instances] == [2, 0, 1]
+    statement, = conn.statements
+    assert statement == "SELECT sku.spu_id, count(*) AS count_1 \nFROM sku \n" \
+                        "WHERE sku.spu_id = ANY (%(param_1)s::INTEGER[]) GROUP BY sku.spu_id"
+
+
+async def test_estimate_count_without_filter():
+    schema = SpuCountSchema()
+
+    conn = FakeConnection(5000000)
+    with use_connection(conn):
+        assert await schema.count({"estimate": True}) == {"count": 5000000, "exact": False}
+    assert conn.statements == ["SELECT reltuples::bigint FROM pg_class WHERE oid = $1::text::regclass"]
+
+    # 没有analyze过的表没有统计信息, 精确计算
+    conn = FakeConnection(-1, 12)
+    with use_connection(conn):
+        assert await schema.count({"estimate": True}) == {"count": 12, "exact": True}
+    assert conn.statements[1].startswith("SELECT count(*) AS count_1 \nFROM spu")
+
+
+async def test_estimate_count_with_filter():
+    schema = SpuCountSchema()
+    plan = ujson.dumps([{"Plan": {"Plan Rows": schema.__estimate_threshold__ * 2}}])
+
+    conn = FakeConnection(plan)
+    with use_connection(conn):
+        assert await schema.count({"estimate": True, "name": "phone"}) == \
+            {"count": schema.__estimate_threshold__ * 2, "exact": False}
+    assert conn.statements[0].startswith("EXPLAIN (FORMAT JSON) SELECT spu.id")
+
+    # 估算的行数较少时精确计算
+    plan = ujson.dumps([{"Plan": {"Plan Rows": 10}}])
+    conn = FakeConnection(plan, 8)
+    with use_connection(conn):
+        assert await schema.count({"estimate": True, "name": "phone"}) == {"count": 8, "exact": True}
+
+    # 没有estimate时不估算
+    conn = FakeConnection(8)
+    with use_connection(conn):
+        assert await schema.count({"name": "phone"}) == {"count": 8, "exact": True}
+    assert len(conn.statements) == 1
+
+
+
+async def test_shaped_statement_follows_the_current_bind():
+    schema = SpuCountSchema()
+    shape = schema.query_shape({"name": "phone"})
+    query = schema._to_queries({"name": "phone"})
+
+    first, second = FakeConnection(1), FakeConnection(2)
+    with use_connection(first):
+        assert await schema.count_rows(query, shape) == 1
+    # 复用的语句不会继续使用第一次执行时的连接
+    with use_connection(second):
+        assert await schema.count_rows(query, shape) == 2
+    assert len(first.statements) == len(second.statements) == 1
+
+
+async def test_bulk_category_cycle_in_one_batch():
+    schema = CateBulkSchema()
+    # 数据库中1, 2都是根分类, 本批数据形成1 -> 2 -> 1
+    conn = FakeConnection([{"id": 1, "parent_id": None, "depth": 0}, {"id": 2, "parent_id": None, "depth": 0}])
+    with use_connection(conn), pytest.raises(SchemaException, match="已有子类"):
+        await schema.check_circular_reference([{"id": 1, "parent_id": 2}, {"id": 2, "parent_id": 1}], True)
+    assert len(conn.statements) == 1
+
+
+async def test_bulk_category_cycle_against_database():
+    schema = CateBulkSchema()
+    # 数据库中3 -> 2 -> 1, 将1移动到3下面
+    conn = FakeConnection([{"id": 1, "parent_id": None, "depth": 0},
+                           {"id": 3, "parent_id": 2, "depth": 0},
+                           {"id": 2, "parent_id": 1, "depth": 1}])
+    with use_connection(conn), pytest.raises(SchemaException, match="已有子类"):
+        await schema.check_circular_reference({"id": 1, "parent_id": 3}, False)
+
+    # 移动到其他分支下没有问题
+    conn = FakeConnection([{"id": 1, "parent_id": None, "depth": 0}, {"id": 4, "parent_id": None, "depth": 0}])
+    with use_connection(conn):
+        await schema.check_circular_reference({"id": 1, "parent_id": 4}, False)
+
+
+async def test_bulk_category_self_parent():
+    schema = CateBulkSchema()
+    conn = FakeConnection()
+    with use_connection(conn), pytest.raises(SchemaException, match="自己"):
+        await schema.check_circular_reference([{"id": 1, "parent_id": 1}], True)
+    # 不需要查询数据库
+    assert conn.statements == []
+
+    # 新建的分类以及没有修改parent的分类不需要检查
+    with use_connection(conn):
+        await schema.check_circular_reference([{"name": "new", "parent_id": 1}, {"id": 2, "name": "n"}], True)
+    assert conn.statements == []
+
+
+def test_bulk_batches_group_by_given_fields():
+    schema = BrandBulkSchema()
+    rows = [{"name": "a"}, {"name": "b", "id": 2}, {"name": "a"}, {"name": "c"}]
+    size, db.bulk_batch_size = db.bulk_batch_size, 2
+    try:
+        batches = [(set(given), [row["name"] for row in batch]) for given, batch in schema.batches(rows)]
+    finally:
+        db.bulk_batch_size = size
+
+    # 同一批中相同name的行只保留最后一次, 字段不同的行分开写入
+    assert batches == [({"name"}, ["a", "c"]), ({"name", "id"}, ["b"])]
+
+
+def test_bulk_batches_limited_by_params():
+    schema = BrandBulkSchema()
+    rows = [{"name": str(i)} for i in range(10)]
+    columns = len(schema.fill_defaults({"name": "0"}))
+    max_params, BrandBulkSchema.MAX_PARAMS = BrandBulkSchema.MAX_PARAMS, columns * 4
+    try:
+        sizes = [len(batch) for _, batch in schema.batches(rows)]
+    finally:
+        BrandBulkSchema.MAX_PARAMS = max_params
+    assert sizes == [4, 4, 2]
+
+
+class FakeTransactionConnection(FakeConnection):
+    """记录事务的开始和提交"""
+
+    @asynccontextmanager
+    async def _transaction(self):
+        self.statements.append("BEGIN")
+
+        class Transaction:
+            async def raise_commit(_):
+                self.statements.append("COMMIT")
+
+            async def rollback(_):
+                self.statements.append("ROLLBACK")
+
+        yield Transaction()
+
+    def transaction(self):
+        return self._transaction()
+
+
+async def test_bulk_upsert_one_transaction_per_batch():
+    schema = BrandBulkSchema()
+    rows = [{"name": str(i)} for i in range(3)]
+    conn = FakeTransactionConnection(
+        [{"id": 1}],  # 第一批: 已经存在的行
+        [{"id": 1}, {"id": 2}],  # 第一批: 写入的行
+        [(10,)],  # 品牌下的spu, 提交之后使缓存失效
+        [],
+        [{"id": 3}],
+        [],
+    )
+    size, db.bulk_batch_size = db.bulk_batch_size, 2
+    try:
+        with use_connection(conn):
+            assert await schema.bulk_upsert(rows, True) == {"count": 3}
+    finally:
+        db.bulk_batch_size = size
+
+    statements = [s.split(" ", 1)[0] for s in conn.statements]
+    assert statements == ["BEGIN", "SELECT", "INSERT", "COMMIT", "SELECT",
+                          "BEGIN", "SELECT", "INSERT", "COMMIT", "SELECT"]
+    insert = conn.statements[2]
+    assert "VALUES (%(name_m0)s" in insert and "(%(name_m1)s" in insert
+    assert "ON CONFLICT (name) DO" in insert and "RETURNING brands.id" in insert
+
+
+class FakeCursorConnection(FakeTransactionConnection):
+    """游标打开期间不能在同一个连接上执行其他查询"""
+
+    def __init__(self, *results, rows=()):
+        super().__init__(*results)
+        self.rows = list(rows)
+        self.iterating = False
+
+    async def _execute(self, clause, *multiparams, **params):
+        assert not self.iterating, "the connection is busy with a cursor"
+        return await super()._execute(clause, *multiparams, **params)
+
+    all = first = scalar = status = _execute
+
+    async def iterate(self, clause):
+        self.statements.append(str(clause.compile(dialect=self.dialect)))
+        self.iterating = True
+        try:
+            for row in self.rows:
+                yield row
+        finally:
+            self.iterating = False
+
+
+class FakeResponse:
+    def __init__(self):
+        self.chunks = list()
+
+    async def write(self, data):
+        self.chunks.append(data)
+
+
+async def test_export_runs_chunk_queries_on_second_connection():
+    cursor_conn = FakeCursorConnection(rows=[Brand(id=1, name="a"), Brand(id=2, name="b"), Brand(id=3, name="c")])
+    # 每一批的spus_nums注解
+    chunk_conn = FakeCursorConnection([(1, 5)], [])
+    connections = [cursor_conn, chunk_conn]
+
+    class ExportEngine(FakeEngine):
+        @asynccontextmanager
+        async def acquire(self, reuse=True, reusable=True):
+            assert not reuse and not reusable
+            yield connections.pop(0)
+
+    db.bind = ExportEngine()
+    try:
+        schema = BrandExportSchema(only=("id", "spus_nums"))
+        schema.__export_chunk__ = 2
+        response = FakeResponse()
+        await schema.export(Brand.id > 0, response)
+    finally:
+        db.bind = None
+
+    # 游标在事务中, 只有一条查询
+    assert [s.split(" ", 1)[0] for s in cursor_conn.statements] == ["BEGIN", "SELECT"]
+    assert len(chunk_conn.statements) == 2
+    assert all("FROM spu" in s for s in chunk_conn.statements)
+
+    lines = [ujson.loads(line) for line in "".join(response.chunks).splitlines()]
+    assert len(response.chunks) == 2
+    assert lines == [{"id": 1, "spus_nums": 5}, {"id": 2, "spus_nums": 0}, {"id": 3, "spus_nums": 0}]
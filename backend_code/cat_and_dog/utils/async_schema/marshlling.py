@@ -70,5 +70,44 @@ class Unmarshaller(_Unmarshaller):
                     errors.setdefault(field_name, []).append(text_type(err))
 
 
+def compile_dump_plan(fields_dict, prefix=None) -> tuple:
+    """
+    预先计算需要dump的字段, 生成`(key, attr_name, serialize)`的列表,
+    避免每次dump时都重新判断`load_only`, 拼接key, 创建getter
+    """
+    return tuple((''.join([prefix or '', field_obj.dump_to or attr_name]), attr_name, field_obj.serialize)
+                 for attr_name, field_obj in fields_dict.items()
+                 if not getattr(field_obj, 'load_only', False))
+
+
 class Marshaller(_Marshaller):
-    pass
+    def serialize(self, obj, fields_dict, many=False, accessor=None, dict_class=dict, index_errors=True,
+                  index=None, plan=None):
+        """
+        有`plan`时直接按照plan循环dump, 出现错误时再交给原来的方法处理, 以便收集错误信息
+
+        .. seealso::
+            :ref: `compile_dump_plan`
+        """
+        if plan is None or obj is None:
+            return super().serialize(obj, fields_dict, many=many, accessor=accessor, dict_class=dict_class,
+                                     index_errors=index_errors, index=index)
+        try:
+            if many:
+                return [self._serialize_with_plan(item, plan, accessor, dict_class) for item in obj]
+            return self._serialize_with_plan(obj, plan, accessor, dict_class)
+        except ValidationError:
+            return super().serialize(obj, fields_dict, many=many, accessor=accessor, dict_class=dict_class,
+                                     index_errors=index_errors, index=index)
+
+    @staticmethod
+    def _serialize_with_plan(obj, plan, accessor, dict_class):
+        items = []
+        for key, attr_name, serialize in plan:
+            value = serialize(attr_name, obj, accessor=accessor)
+            if value is missing:
+                continue
+            items.append((key, value))
+        return dict_class(items)
+
+    __call__ = serialize
@@ -1,17 +1,36 @@
 # -*- coding: utf-8 -*-
-import asyncio
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, date
 from functools import reduce
-from inspect import isawaitable
 from typing import *
 
+import ujson
 from marshmallow import fields
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, tuple_, bindparam
+from sqlalchemy.sql import visitors, ClauseElement
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.dialects.postgresql import insert
 
-from cat_and_dog.modules import Base, db
+from cat_and_dog.modules import Base, db, detail_cache
 from cat_and_dog.utils.async_schema.process import (async_post_load, async_validates_schema, async_pre_load,
                                                     async_pre_dump)
 from cat_and_dog.utils.empty import Empty
 from cat_and_dog.utils.errors.exceptions import SchemaException
+from cat_and_dog.utils.relations.identity_map import current_identity_map
+from cat_and_dog.utils.cache.lru import LRUCache
+from cat_and_dog.utils.relations.orm_relations import prefetch_relations, RelationalParent, any_of
+from cat_and_dog.utils.request.response import dumps
+
+
+# `MixInBase.shape_statement`缓存的语句
+statement_cache = LRUCache(maxsize=256, ttl=float("inf"))
+
+
+def bind_params(clauses: list) -> list:
+    """子句中的所有参数, 相同结构的子句返回的顺序相同"""
+    return [element for clause in clauses if isinstance(clause, ClauseElement)
+            for element in visitors.iterate(clause, {}) if isinstance(element, BindParameter)]
 
 
 class MixInBase:
@@ -28,6 +47,35 @@ class MixInBase:
         self.dump_field_name = {field_name for field_name, field_obj in self.fields.items() if
                                 not getattr(field_obj, 'load_only', False)}
 
+        self.annotate_fields = {fn: fi for fn, fi in self.fields.items()
+                                if "annotate" in fi.metadata and fn in self.dump_field_name}
+
+        self.key_check_fields = {fn: fi for fn, fi in self.fields.items()
+                                 if "key_check" in fi.metadata and "model" in fi.metadata}
+
+    async def check_foreign_keys(self, rows: List[dict]) -> None:
+        """
+        检查`key_check`字段的外键/主键是否存在
+
+        所有行的值按照模型合并, 每个模型只查询一次:
+            `SELECT id FROM one WHERE id = ANY($1)`
+        """
+        pks: Dict[Base, set] = dict()
+        for row in rows:
+            for field_name, field in self.key_check_fields.items():
+                value = row.get(field_name)
+                if not value:
+                    continue
+                ids = value if isinstance(value, list) else (value,)
+                if any(pk <= 0 for pk in ids):
+                    raise SchemaException("找不到对应的外键或主键")
+                pks.setdefault(field.metadata["model"], set()).update(ids)
+
+        for model, ids in pks.items():
+            found = await model.select("id").where(any_of(model.id, ids)).gino.all()
+            if len(found) != len(ids):
+                raise SchemaException("找不到对应的外键或主键")
+
     def fields_to_queries(self, field_value: Dict[fields.Field, Any]):
         """
         override this method to modify the queries
@@ -54,8 +102,9 @@ class MixInBase:
                     ext_query = True
                     name_field = self.fields["name"]
                     if name_field in field_value:
-                        ext_query = or_(self.__model__.code.like(f"%{field_value[name_field]}%"),
-                                        self.__model__.name.like(f"%{field_value[name_field]}%"))
+                        pattern = self.like_pattern(field_value[name_field])
+                        ext_query = or_(self.__model__.code.like(pattern, escape="\\"),
+                                        self.__model__.name.like(pattern, escape="\\"))
                         copy_value.pop(name_field)
 
                     # it's OK to combine your query with origin query with and_
@@ -82,12 +131,12 @@ class MixInBase:
 
             if field.metadata.get("query") == "like":
                 query_list.append(
-                    getattr(model, field.name).like(f"%{field_value}%")
+                    getattr(model, field.name).like(self.like_pattern(field_value), escape="\\")
                 )
             elif field.metadata.get("query") == "eq":
                 if isinstance(field, fields.List):
                     query_list.append(
-                        getattr(model, field.name).in_(field_value)
+                        any_of(getattr(model, field.name), field_value)
                     )
                 else:
                     query_list.append(
@@ -95,40 +144,208 @@ class MixInBase:
                     )
         return reduce(and_, query_list) if query_list else True
 
+    @staticmethod
+    def like_pattern(value: str) -> str:
+        """
+        转义`%`, `_`之后生成`%value%`, 使用户输入只作为普通字符匹配
+
+        `query="like"`的字段需要在模型上声明`gin_trgm_ops`的GIN索引(见`trgm_index`), 这样`LIKE '%value%'`才能走索引
+        """
+        value = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"%{value}%"
+
+    def search_ranks(self, field_value: Dict[fields.Field, Any]) -> list:
+        """
+        `query="like"`字段的相关度, 列表在没有游标时会按照相关度倒序排列
+
+        override this method together with `fields_to_queries`
+        :return: [similarity(name, $1), ...]
+        """
+        return [db.func.similarity(getattr(self.__model__, field.name), value)
+                for field, value in field_value.items()
+                if field.metadata.get("query") == "like"]
+
+    def _query_values(self, data) -> Dict[fields.Field, Any]:
+        """the `query` fields given in data"""
+        return {field_info: data.get(field_info.name)
+                for field_info in self.query_fields
+                if data.get(field_info.name, Empty) is not Empty}
+
     def _to_queries(self, data):
         if not self.__model__:
             return data
 
-        real_query_field = {field_info: data.get(field_info.name)
-                            for field_info in self.query_fields
-                            if data.get(field_info.name, Empty) is not Empty}
+        real_query_field = self._query_values(data)
 
         queries = self.fields_to_queries(real_query_field)
         return queries
 
-    async def dump_which_relation(self, instance):
+    async def count_rows(self, query, shape: tuple = None) -> int:
+        """
+        `SELECT count(*) FROM model WHERE query`
+        :param shape: 查询的结构, 给出时复用相同结构的语句, 见`shape_statement`
+        """
+        def build(query):
+            return db.select([db.func.count()]).select_from(self.__model__).where(query)
+
+        if shape is None:
+            return await build(query).gino.scalar()
+
+        statement, params = self.shape_statement(("count", *shape), [query], build)
+        return await db.scalar(statement, **params)
+
+    def query_shape(self, data) -> tuple:
+        """
+        查询条件的结构: 给出了哪些`query`字段, 值是列表, None还是单个值
+
+        相同结构的查询生成的SQL只有参数不同
+        """
+        return tuple((field.name, "list" if isinstance(value, list) else value is None)
+                     for field, value in self._query_values(data).items())
+
+    def shape_statement(self, shape: tuple, clauses: list, build: Callable):
+        """
+        按照`shape`缓存完整的语句, 相同结构的查询复用同一个语句对象并且只替换参数:
+            - 语句标记了`shaped`, sqlalchemy的`compiled_cache`以语句对象为key, 不需要再次编译(见`Gino.compiled_cache`)
+            - SQL相同, asyncpg会复用连接上的prepared statement
+
+        :param shape: 查询的结构, 不同结构的查询不能使用相同的key, 见`query_shape`
+        :param clauses: 本次查询中包含参数的子句, 如where, order by
+        :param build: `build(*clauses)`生成完整的语句
+        :return: (statement, params), 使用`db.all(statement, **params)`执行;
+            不能使用`statement.gino`, sqlalchemy的语句在第一次执行时会记住当时的bind(如副本或者独立的连接),
+            复用的语句之后会一直使用该bind
+        """
+        key = (type(self), *shape)
+        binds = bind_params(clauses)
+        cached = statement_cache.get(key)
+        if cached is not None and len(cached[1]) == len(binds):
+            statement, names = cached
+            return statement, {name: bind.effective_value for name, bind in zip(names, binds)}
+
+        statement = build(*clauses).execution_options(shaped=True)
+        compiled = statement.compile(dialect=db.bind.dialect)
+        statement_cache.set(key, (statement, [compiled.bind_names[bind] for bind in binds]))
+        return statement, dict()
+
+    def eager_query(self):
+        """
+        根据`Meta.eager_load`生成JOIN语句以及对应的loader
+
+        只有many2one/one2one关系会使用JOIN, 一对多的关系JOIN之后会使limit/offset失效,
+        因此交给`prefetch_relations`批量加载
+
+        - example:
+
+            ```python
+            class SpuListSchema(ListMixin, SpuBase):
+                class Meta(BaseSchema.Meta):
+                    eager_load = ("category", "brand", "skus")
+
+            # SELECT spu.*, categories_1.*, brands_1.* FROM spu
+            #   LEFT OUTER JOIN categories AS categories_1 ON categories_1.id = spu.category_id
+            #   LEFT OUTER JOIN brands AS brands_1 ON brands_1.id = spu.brand_id
+            # SELECT * FROM sku WHERE sku.spu_id IN (...)
+            ```
+
+        :return: (select, loader, the names of to-one relations, the names of to-many relations)
+        """
+        model = self.__model__
+        from_clause = model
+        extras = dict()
+        to_many = list()
+
+        for name in self.opts.eager_load:
+            relationship = getattr(model, name)
+            relationship.resolve(model)
+            if relationship.relation not in ("many2one", "one2one"):
+                to_many.append(name)
+                continue
+            # 使用别名, 使自关联(如分类的parent)也可以JOIN
+            related = relationship.related_model.alias()
+            from_clause = from_clause.outerjoin(related, related.id == getattr(model, relationship.fk))
+            extras[name] = related
+
+        if not extras:
+            return model.query, None, (), to_many
+        return from_clause.select(), model.load(**extras), tuple(extras), to_many
+
+    @staticmethod
+    async def finish_eager_load(instances: list, to_one, to_many) -> None:
+        """`eager_query`的查询结果: JOIN没有找到的关联设为None, 批量加载一对多的关联"""
+        for i in instances:
+            for name in to_one:
+                # LEFT JOIN没有找到对应的行, 即外键为空
+                if isinstance(getattr(i, name), RelationalParent):
+                    setattr(i, name, None)
+
+        await prefetch_relations(instances, to_many)
+
+    def relations_to_dump(self, instance) -> set:
         """
         为了不全量加载relation 属性, 判断目前的schema中有没有需要dump的字段
         :param instance:
+        :return: the names of the relations
+        """
+        return getattr(instance, "__rel__", set()) & self.dump_field_name
+
+    async def dump_which_relation(self, instance):
+        """
+        加载一个实例需要dump的relation
+        :param instance:
         :return:
         """
-        to_dump = instance.__rel__ & self.dump_field_name
-        # print(to_dump)
-        for d in to_dump:
-            _d = getattr(instance, d)
-            if isawaitable(_d):
-                await _d
+        await prefetch_relations([instance], self.relations_to_dump(instance))
 
-    @async_pre_dump
-    async def await_for_relation(self, data: Awaitable or List):
-        """await for the instance relationship, load了所有的关系, 因此性能八太好, 应该判断当前schema需要dump的字段"""
+    async def annotate(self, instances: list):
+        """
+        计算`annotate`字段的聚合值, 每个字段只执行一次`GROUP BY`查询
 
-        # 获取当前schema需要dump的字段
+        - example:
 
-        # await这个字段, i.e. 加载一个关系属性
-        if isinstance(data, list):
-            return await asyncio.wait([self.dump_which_relation(d) for d in data])
-        return await self.dump_which_relation(data)
+            ```python
+            class BrandListSchema(ListMixin, BrandBase):
+                spus_nums = fields.Integer(dump_only=True, annotate="count", model=Spu, fk="brand_id")
+                max_price = fields.Float(dump_only=True, annotate="max", model=Sku, fk="spu_id", column="price")
+
+            # SELECT spu.brand_id, count(*) FROM spu WHERE spu.brand_id IN (...) GROUP BY spu.brand_id
+            ```
+
+        :param instances: instances of `self.__model__`
+        """
+        ids = {i.id for i in instances}
+
+        for field_name, field in self.annotate_fields.items():
+            model = field.metadata["model"]
+            fk = getattr(model, field.metadata["fk"])
+            aggregate = field.metadata["annotate"]
+            column = field.metadata.get("column")
+            func = getattr(db.func, aggregate)
+            default = 0 if aggregate == "count" else None
+
+            values = dict()
+            if ids:
+                rows = await db.select([fk, func(getattr(model, column)) if column else func()]). \
+                    where(any_of(fk, ids)). \
+                    group_by(fk).gino.all()
+                values = {r[0]: r[1] for r in rows}
+
+            for i in instances:
+                setattr(i, field.attribute or field_name, values.get(i.id, default))
+
+    @async_pre_dump(pass_many=True)
+    async def await_for_relation(self, data: Any, many: bool):
+        """await for the instance relationship, 只加载当前schema需要dump的关系,
+        many=True时, 每个relation只执行一次`IN (...)`查询, 避免N+1查询
+        同时计算`annotate`字段
+        """
+        instances = data if many else [data]
+        if not instances or not hasattr(instances[0], "__rel__"):
+            return data
+
+        await prefetch_relations(instances, self.relations_to_dump(instances[0]))
+        await self.annotate(instances)
+        return data
 
 
 class PreLoadListMixin:
@@ -154,24 +371,64 @@ class PreLoadListMixin:
         return data
 
 
+class Page(list):
+    """
+    分页查询的结果, `meta`中保存了分页的额外信息, 如下一页的游标
+    """
+
+    def __init__(self, iterable=(), **meta):
+        super().__init__(iterable)
+        self.meta = meta
+
+
 class ListMixin(MixInBase):
     """
     检查分页, mixin应该放在ma.ModelSchema之前
+
+    支持两种分页方式:
+        - limit/offset(或者page/per_page)
+        - after/limit(或者after/per_page), 使用游标分页, 在`(__sort_key__, id)`上翻页,
+          深度分页时不需要扫描并丢弃前面的行; `__sort_key__`为NULL的行排在最后, 同样可以翻页
+
+    返回的`Page.meta["next"]`为下一页的游标, 没有下一页时为None;
+    第一页可以使用`limit/offset=0`获取, 之后使用`after=<next>`翻页;
+    `query="like"`的查询在没有after时按照相关度排序, 与游标的顺序不同, 此时`next`也为None, 只能使用offset翻页
+
+    `with_total=1`时`Page.meta["total"]`为符合条件的总数:
+        - limit/offset: 使用窗口函数`count(*) OVER ()`在同一个查询中计算
+        - after: 游标条件会影响窗口函数, 因此使用相同的where再执行一次count
     """
 
+    # 游标分页排序的字段, 为None时只按照id排序; 最好有`(__sort_key__, id)`的索引
+    __sort_key__: str = None
+
     limit = fields.Integer(load_only=True)
     offset = fields.Integer(load_only=True)
     page = fields.Integer(load_only=True)
     per_page = fields.Integer(load_only=True)
+    after = fields.String(load_only=True)
+    # 同时返回总数, 不需要再请求`/count`
+    with_total = fields.Boolean(load_only=True)
 
     @async_validates_schema
     async def validate_for_pagination(self, data: dict):
-        """验证limit和offset或者page/per_page"""
+        """验证limit和offset或者page/per_page, 或者after和limit/per_page"""
         limit = data.get("limit")
         offset = data.get("offset")
         page = data.get("page")
         per_page = data.get("per_page")
 
+        if data.get("after") is not None:
+            # 游标分页不能和offset/page一起使用
+            if not all((offset is None, page is None)):
+                raise SchemaException("after不能和offset/page一起使用")
+            size = limit if limit is not None else per_page
+            if size is None:
+                raise SchemaException("after必须和limit或者per_page一起使用")
+            if size < 1:
+                raise SchemaException("limit/per_page必须大于0")
+            return
+
         if not any((limit is None, offset is None)):
             # limit/offset必须一起传入
             if any((limit < 1, offset < 0)):
@@ -189,13 +446,98 @@ class ListMixin(MixInBase):
     @async_post_load
     async def convert_page_to_limit(self, data: dict):
         """将page转换成limit"""
-        if data.get("page"):
+        if data.get("after") is not None:
+            data.setdefault("limit", data.get("per_page"))
+            data["offset"] = None
+        elif data.get("page"):
             limit = data["per_page"]
             offset = data["per_page"] * (data["page"] - 1)
             data["limit"] = limit
             data["offset"] = offset
         return data
 
+    def sort_columns(self) -> list:
+        """分页排序的字段, id放在最后保证顺序唯一"""
+        model = self.__model__
+        if self.__sort_key__:
+            return [getattr(model, self.__sort_key__), model.id]
+        return [model.id]
+
+    def order_columns(self) -> list:
+        """`ORDER BY sort_key ASC NULLS LAST, id`"""
+        columns = self.sort_columns()
+        if len(columns) == 1:
+            return columns
+        return [columns[0].asc().nullslast(), *columns[1:]]
+
+    def encode_cursor(self, instance) -> str:
+        """将最后一行的排序字段编码为游标"""
+        values = []
+        for column in self.sort_columns():
+            value = getattr(instance, column.key)
+            values.append(value.isoformat() if isinstance(value, (datetime, date)) else value)
+        return urlsafe_b64encode(ujson.dumps(values).encode()).decode()
+
+    @staticmethod
+    def cursor_value(column, value):
+        """按照字段的类型转换游标中的值, 类型不符时抛出ValueError, 避免伪造的游标在数据库中报错"""
+        python_type = column.type.python_type
+        if python_type in (datetime, date):
+            return python_type.fromisoformat(value)
+        if python_type is float and isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if not isinstance(value, python_type) or (isinstance(value, bool) and python_type is not bool):
+            raise ValueError(value)
+        return value
+
+    def decode_cursor(self, cursor: str) -> list:
+        """游标解码为最后一行的排序字段"""
+        columns = self.sort_columns()
+        try:
+            values = ujson.loads(urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(columns) or values[-1] is None:
+                raise ValueError(cursor)
+            values = [value if value is None else self.cursor_value(column, value)
+                      for column, value in zip(columns, values)]
+        except (ValueError, TypeError, binascii.Error):
+            raise SchemaException("after游标不正确")
+        return values
+
+    def cursor_condition(self, values: list):
+        """
+        最后一行之后的行, 与`order_columns`的顺序一致:
+            - 排序字段不为NULL: `(sort_key, id) > (value, id) OR sort_key IS NULL`
+            - 排序字段为NULL: `sort_key IS NULL AND id > id`, 只剩下NULL的行
+        """
+        columns = self.sort_columns()
+        if len(columns) == 1:
+            return columns[0] > values[0]
+
+        sort_key, id_column = columns
+        if values[0] is None:
+            return and_(sort_key.is_(None), id_column > values[1])
+        return or_(tuple_(sort_key, id_column) > tuple_(*values), sort_key.is_(None))
+
+    def list_order(self, data: dict):
+        """
+        列表的排序, 相关度无法作为游标, 只在没有after时排在最前面
+        :return: (order_by, 是否按照相关度排序)
+        """
+        order_by = self.order_columns()
+        if data.get("after") is not None:
+            return order_by, False
+
+        ranks = self.search_ranks(self._query_values(data))
+        if not ranks:
+            return order_by, False
+        return [reduce(lambda a, b: a + b, ranks).desc(), *order_by], True
+
+    def next_cursor(self, instances: list, limit: int, ranked: bool):
+        """下一页的游标, 按照相关度排序时after之后的顺序不同, 会跳过或者重复一些行, 因此不返回游标"""
+        if ranked or len(instances) < limit:
+            return None
+        return self.encode_cursor(instances[-1])
+
     @async_post_load
     async def make_queries(self, data: dict):
         """
@@ -203,8 +545,55 @@ class ListMixin(MixInBase):
         :param data:
         :return:
         """
-        query = self._to_queries(data)
-        return await self.__model__.query.where(query).limit(data["limit"]).offset(data["offset"]).gino.all()
+        where = query = self._to_queries(data)
+        cursor_shape = ()
+        if data.get("after") is not None:
+            values = self.decode_cursor(data["after"])
+            query = and_(where, self.cursor_condition(values))
+            # 排序字段为NULL时游标条件的结构不同
+            cursor_shape = tuple(value is None for value in values)
+
+        order_by, ranked = self.list_order(data)
+        with_total = data.get("with_total", False)
+        window_total = with_total and data.get("after") is None
+        shape = self.query_shape(data)
+        _, _, to_one, to_many = self.eager_query()
+
+        def build(query, *order_by):
+            statement, loader, _, _ = self.eager_query()
+            statement = statement.where(query). \
+                order_by(*order_by). \
+                limit(bindparam("limit")). \
+                offset(bindparam("offset"))
+            if window_total:
+                total_column = db.func.count().over().label("total")
+                statement = statement.column(total_column)
+                loader = (loader or self.__model__, total_column)
+            if loader is not None:
+                statement = statement.execution_options(loader=loader)
+            return statement
+
+        statement, params = self.shape_statement(
+            ("list", data.get("after") is not None, cursor_shape, len(order_by), window_total, *shape),
+            [query, *order_by],
+            build
+        )
+        instances = await db.all(statement, limit=data["limit"], offset=data["offset"], **params)
+
+        meta = dict()
+        if window_total:
+            meta["total"] = instances[0][1] if instances else 0
+            instances = [i for i, _ in instances]
+            if not instances and data["offset"]:
+                # 超出最后一页时窗口函数没有结果
+                meta["total"] = await self.count_rows(where, shape)
+        elif with_total:
+            meta["total"] = await self.count_rows(where, shape)
+
+        await self.finish_eager_load(instances, to_one, to_many)
+
+        meta["next"] = self.next_cursor(instances, data["limit"], ranked)
+        return Page(instances, **meta)
 
 
 class DetailMixIn(MixInBase):
@@ -215,46 +604,28 @@ class DetailMixIn(MixInBase):
     **特别说明**:
         - `key_check`则是用来检查外键是否合法, 而`fk`参数是用来创建/修改关联(更新表数据)
 
-            - key_check: `SELECT id FROM one WHERE id = $1 `
+            - key_check: `SELECT id FROM one WHERE id = ANY($1)`, 同一个模型的所有外键一起检查
 
             - fk: UPDATE `many SET fk = $1 WHERE many.id IN ($2)`
     """
 
-    __relations__: Dict[str, Tuple[Base, List[int]]] = dict()
-
-    @staticmethod
-    async def check_foreign_exits(model: Base, pk: int or list) -> None or List:
-        """
-        检查外键是否存在
-        :param Base model: 关联外键的模型
-        :param pk: 外键/主键
-        :return: None or List
-        """
-        if pk is None:
-            return
-        if isinstance(pk, int):
-            if pk <= 0 or (not await model.get(pk)):
-                raise SchemaException("找不到对应的外键或主键")
-        elif isinstance(pk, list) and pk:
-            pk = tuple(pk)
-            relations = await model.select("id").where(model.id.in_(pk)).gino.all()
-            if len(relations) != len(pk):
-                raise SchemaException("找不到对应的外键或主键")
-            return [r[0] for r in relations]
-
-    @async_post_load
-    async def if_foreign_exist(self, data: dict):
-        """自动判断外键是否存在"""
-        check_fields = {f: v for f, v in self.fields.items() if data.get(f) and "key_check" in v.metadata}
-
-        for field_name, field in check_fields.items():
-            relations = await self.check_foreign_exits(field.metadata["model"], data.get(field_name))
-
-            if relations:
-                # 记录下查询到的fk值, 避免更新/创建时再次查询
-                # 作为`一`的一方, 本身是不包含任何外键信息的, 因此data中将外键list剔除
-                data.pop(field_name)
-                self.__relations__[field.metadata["fk"]] = (field.metadata["model"], relations)
+    # 在data中记录已经检查过的关联: Dict[str, Tuple[Base, List[int]]]
+    # 不能保存在schema上, schema实例会在请求之间复用
+    RELATIONS_KEY = "__relations__"
+
+    @async_post_load(pass_many=True)
+    async def if_foreign_exist(self, data, many):
+        """自动判断外键是否存在, `many=True`时所有数据一起检查"""
+        rows = data if many else [data]
+        await self.check_foreign_keys(rows)
+
+        for row in rows:
+            for field_name, field in self.key_check_fields.items():
+                if "fk" in field.metadata and row.get(field_name):
+                    # 记录下检查过的fk值, 更新/创建时使用
+                    # 作为`一`的一方, 本身是不包含任何外键信息的, 因此data中将外键list剔除
+                    ids = list(dict.fromkeys(row.pop(field_name)))
+                    row.setdefault(self.RELATIONS_KEY, dict())[field.metadata["fk"]] = (field.metadata["model"], ids)
         return data
 
     @async_post_load
@@ -262,11 +633,17 @@ class DetailMixIn(MixInBase):
         """创建instance, 关联relations, 如果是不需要创建或者修改可以直接返回data
         `fk`用于在这里创建关联
         """
+        relations = data.pop(self.RELATIONS_KEY, dict())
+        old_values = None
+        # 缓存中需要失效的实例
+        stale = set()
+
         async with db.auto_commit():
             if data.get("id"):
                 # update
                 _id = data.pop("id")
-                instance = await self.__model__.get(_id)
+                instance = await self.__model__.get_for_update(_id)
+                old_values = dict(instance.__values__)
                 await instance.update(**data).apply()
             else:
                 # create
@@ -274,19 +651,229 @@ class DetailMixIn(MixInBase):
 
             _id = instance.id
 
-            for fk, (model, ids) in self.__relations__.items():
+            for fk, (model, ids) in relations.items():
+                # the old `one` side of the many side will lose some children
+                owners = await model.select(fk).where(model.id.in_(ids)).gino.all()
+                stale.update((self.__model__, o[0]) for o in owners if o[0] is not None)
+                stale.update((model, i) for i in ids)
+
                 # update the many side, the the fk to the instance id
                 # this is like
                 # update model set model.fk = $1 where model.id in (ids) -- $1 is the one side we just create or update
                 await model.update.values(**{fk: _id}).where(model.id.in_(ids)).gino.status()
 
         instance.init_the_relation()
+
+        stale.update(await detail_cache.related(instance, old_values))
+        await detail_cache.invalidate(stale)
         return instance
 
 
+class BulkMixIn(MixInBase):
+    """
+    批量创建/更新, 使用`many=True`加载, 返回`{"count": 写入的行数}`
+
+    使用多行的`INSERT ... ON CONFLICT (__conflict_key__) DO UPDATE`写入,
+    每`BULK_BATCH_SIZE`行一个事务, 已经提交的批次不会因为之后的批次失败而回滚
+
+    - example:
+
+        ```python
+        class SkuBulkSchema(BulkMixIn, SkuBase):
+            __conflict_key__ = "code"
+
+        # INSERT INTO sku (name, code, ...) VALUES ($1, $2, ...), ($9, $10, ...), ...
+        #   ON CONFLICT (code) DO UPDATE SET name = excluded.name, ...
+        ```
+
+    **特别说明**:
+        - 只支持表本身的字段, 不支持`fk`参数(更新另一张表的关联)
+        - 只会更新数据中给出的字段, 默认值只在插入时使用
+        - 所有行的`key_check`字段一起检查, 见`check_foreign_keys`
+    """
+
+    __conflict_key__ = "id"
+
+    # asyncpg一条语句最多32767个参数
+    MAX_PARAMS = 32767
+
+    def fill_defaults(self, row: dict) -> dict:
+        """多行INSERT需要手动填充python端的默认值"""
+        for column in self.__model__.__table__.columns:
+            default = column.default
+            if column.key in row or column.primary_key or default is None:
+                continue
+            if default.is_callable:
+                row[column.key] = default.arg(None)
+            elif default.is_scalar:
+                row[column.key] = default.arg
+        return row
+
+    def upsert_statement(self, rows: List[dict], given: Iterable[str]):
+        table = self.__model__.__table__
+        statement = insert(table).values(rows)
+
+        update_columns = {c.key: statement.excluded[c.key] for c in table.columns
+                          if c.key in given or (c.onupdate is not None and c.key in rows[0])}
+        update_columns.pop(self.__conflict_key__, None)
+        update_columns.pop("id", None)
+
+        if update_columns:
+            statement = statement.on_conflict_do_update(index_elements=[self.__conflict_key__], set_=update_columns)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[self.__conflict_key__])
+        return statement.returning(*self._returning_columns())
+
+    def _returning_columns(self) -> list:
+        """id以及many2one的外键, 用于使缓存失效"""
+        model = self.__model__
+        columns = [model.id]
+        for name in model.__rel__:
+            relationship = getattr(model, name)
+            relationship.resolve(model)
+            if relationship.relation in ("many2one", "one2one"):
+                columns.append(getattr(model, relationship.fk))
+        return columns
+
+    def batches(self, rows: List[dict]):
+        """按照给出的字段分组(多行INSERT的每一行字段必须相同), 再按照批次大小切分"""
+        groups: Dict[frozenset, dict] = dict()
+        for row in rows:
+            group = groups.setdefault(frozenset(row), dict())
+            # 同一条语句中不能多次更新同一行, 以最后一次为准
+            key = row.get(self.__conflict_key__)
+            group[key if key is not None else object()] = row
+
+        for given, group in groups.items():
+            group = [self.fill_defaults(row) for row in group.values()]
+            size = max(1, min(db.bulk_batch_size, self.MAX_PARAMS // len(group[0])))
+            for i in range(0, len(group), size):
+                yield given, group[i:i + size]
+
+    @async_post_load(pass_many=True)
+    async def bulk_upsert(self, data, many):
+        rows = data if many else [data]
+        if not rows:
+            return {"count": 0}
+
+        await self.check_foreign_keys(rows)
+
+        model = self.__model__
+        conflict_column = getattr(model, self.__conflict_key__)
+        count = 0
+
+        for given, batch in self.batches(rows):
+            keys = [row[self.__conflict_key__] for row in batch if row.get(self.__conflict_key__) is not None]
+
+            async with db.auto_commit():
+                # 更新之前的外键, 原来的parent的缓存也需要失效
+                old = await model.select(*(c.key for c in self._returning_columns())). \
+                    where(conflict_column.in_(keys)).gino.all() if keys else []
+                new = await db.all(self.upsert_statement(batch, given))
+
+            count += len(new)
+            await detail_cache.invalidate(await detail_cache.related_rows(model, [*old, *new]))
+
+        return {"count": count}
+
+
+class ExportMixIn(MixInBase):
+    """
+    导出所有满足条件的数据, 返回NDJSON(每行一个对象)
+
+    使用服务端游标(`iterate`)读取, 每`__export_chunk__`行dump一次并写入streaming response,
+    占用的内存与导出的行数无关; 导出期间占用两个连接, 一个保持游标, 另一个执行每一批的关联查询
+
+    - example:
+
+        ```python
+        schema = SpuExportSchema.shared(strict=True)
+        query, error = await schema.async_load(request.single_args)
+        return stream(partial(schema.export, query), content_type="application/x-ndjson")
+        ```
+    """
+
+    __export_chunk__ = 500
+
+    @async_post_load
+    async def make_export_query(self, data: dict):
+        return self._to_queries(data)
+
+    async def export(self, query, response) -> None:
+        """
+        :param query: `async_load`的结果
+        :param response: StreamingHTTPResponse
+        """
+        statement, loader, to_one, to_many = self.eager_query()
+        statement = statement.where(query).order_by(self.__model__.id)
+        if loader is not None:
+            statement = statement.execution_options(loader=loader)
+
+        # streaming的时候请求的连接已经释放, 服务端游标需要在事务中
+        async with db.isolated_connection() as cursor_conn:
+            async with cursor_conn.transaction():
+                # 游标打开期间它的连接不能执行其他查询, 每一批的预加载以及注解在另一个连接上执行
+                async with db.isolated_connection():
+                    chunk = list()
+                    async for instance in cursor_conn.iterate(statement):
+                        chunk.append(instance)
+                        if len(chunk) >= self.__export_chunk__:
+                            await self._write_chunk(chunk, to_one, to_many, response)
+                            chunk = list()
+                    if chunk:
+                        await self._write_chunk(chunk, to_one, to_many, response)
+
+    async def _write_chunk(self, chunk: list, to_one, to_many, response) -> None:
+        await self.finish_eager_load(chunk, to_one, to_many)
+        data, error = await self.async_dump(chunk, many=True)
+        await response.write("".join(dumps(item) + "\n" for item in data))
+
+        # 已经写入的实例不再需要保存在identity map中
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.clear()
+
+
 class CountMixIn(MixInBase):
+    """
+    返回`{"count": 100, "exact": true}`
+
+    `estimate=1`时, 对于数据量很大的表可以使用postgresql的统计信息估算总数, 避免全表扫描:
+        - 没有过滤条件时读取`pg_class.reltuples`
+        - 有过滤条件时读取`EXPLAIN`估算的行数, 超过`__estimate_threshold__`才使用估算值, 否则精确计算
+
+    估算值可能不准确, 此时`exact`为false
+    """
+
+    __estimate_threshold__ = 100000
+
+    estimate = fields.Boolean(load_only=True)
+
+    async def estimate_rows(self, query, has_filter: bool) -> int or None:
+        """
+        估算满足条件的行数
+        :return: None if the statistics are not available
+        """
+        if not has_filter:
+            rows = await db.scalar("SELECT reltuples::bigint FROM pg_class WHERE oid = $1::text::regclass",
+                                   self.__model__.__tablename__)
+            # the table has never been analyzed
+            return rows if rows and rows > 0 else None
+
+        statement, params = db.compile(db.select([self.__model__.id]).where(query))
+        plan = await db.scalar("EXPLAIN (FORMAT JSON) " + statement, *params)
+        if isinstance(plan, str):
+            plan = ujson.loads(plan)
+        return plan[0]["Plan"]["Plan Rows"]
+
     @async_post_load
     async def count(self, data):
         query = self._to_queries(data)
-        count = await db.select([db.func.count()]).select_from(self.__model__).where(query).gino.status()
-        return count[1][0].values()[0]
+
+        if data.get("estimate"):
+            has_filter = bool(self._query_values(data))
+            rows = await self.estimate_rows(query, has_filter)
+            if rows is not None and (not has_filter or rows >= self.__estimate_threshold__):
+                return {"count": rows, "exact": False}
+
+        return {"count": await self.count_rows(query, self.query_shape(data)), "exact": True}
@@ -1,9 +1,12 @@
+import asyncio
 import functools
+from contextlib import asynccontextmanager
 from collections import Mapping
 
-from marshmallow import Schema as _Schema, UnmarshalResult, ValidationError, missing, utils, MarshalResult
+from marshmallow import Schema as _Schema, SchemaOpts as _SchemaOpts, UnmarshalResult, ValidationError, missing, utils, \
+    MarshalResult
 
-from cat_and_dog.utils.async_schema.marshlling import Unmarshaller, Marshaller
+from cat_and_dog.utils.async_schema.marshlling import Unmarshaller, Marshaller, compile_dump_plan
 from cat_and_dog.utils.async_schema.process import (ASYNC_PRE_DUMP,
                                                     ASYNC_POST_DUMP,
                                                     ASYNC_PRE_LOAD,
@@ -12,6 +15,30 @@ from cat_and_dog.utils.async_schema.process import (ASYNC_PRE_DUMP,
                                                     ASYNC_VALIDATES_SCHEMA)
 
 
+class SchemaOpts(_SchemaOpts):
+    """
+    添加了额外的Meta选项:
+
+        - eager_load: 需要预先加载的relation名称, 如: `eager_load = ("category", "brand")`
+        - concurrency: `many=True`时每一项的异步validator/processor最多同时执行的数量, 默认为0(依次执行),
+          为True时由`Schema.concurrency_limit`决定;
+          每一项在各自的task以及连接(`concurrent_scope`)中执行, 不在请求的事务中, 其中修改的ContextVar
+          (如读写分离的路由状态)也不会传回请求, 因此只能用于只读的validator/processor, 写入数据的schema不能开启
+    """
+
+    def __init__(self, meta):
+        super().__init__(meta)
+        self.eager_load = getattr(meta, 'eager_load', ())
+        if not isinstance(self.eager_load, (list, tuple)):
+            raise ValueError("`eager_load` must be a list or tuple.")
+        self.concurrency = getattr(meta, 'concurrency', 0)
+        if not isinstance(self.concurrency, int) or self.concurrency < 0:
+            raise ValueError("`concurrency` must be a positive integer or a bool.")
+
+
+_shared_schemas = dict()
+
+
 class Schema(_Schema):
     """
     ASYNC SCHEMA
@@ -22,6 +49,59 @@ class Schema(_Schema):
 
     `async_load`, `async_dump` won't call original `load` and `dump`
     """
+    OPTIONS_CLASS = SchemaOpts
+
+    @classmethod
+    def shared(cls, **kwargs):
+        """
+        返回可以在请求之间复用的schema实例, 避免每个请求都重新初始化字段
+
+        use::
+            schema = SpuListSchema.shared(strict=True)
+
+        schema的load/dump不能在实例上保存请求相关的状态, 因此不支持`context`参数
+        """
+        key = (cls, tuple(sorted((k, tuple(v) if isinstance(v, (list, set)) else v)
+                                 for k, v in kwargs.items())))
+        schema = _shared_schemas.get(key)
+        if schema is None:
+            schema = _shared_schemas[key] = cls(**kwargs)
+        return schema
+
+    def concurrency_limit(self) -> int:
+        """`Meta.concurrency`为True时可以在子类中根据资源(如数据库连接池)决定"""
+        return int(self.opts.concurrency)
+
+    @asynccontextmanager
+    async def concurrent_scope(self):
+        """每个并发执行的validator/processor所在的上下文, 如: 使用独立的数据库连接"""
+        yield
+
+    async def _async_map(self, func, items) -> list:
+        """
+        对每一项执行`await func(item)`, 返回的结果与items的顺序一致
+
+        开启`Meta.concurrency`时使用semaphore限制同时执行的数量
+        """
+        limit = self.concurrency_limit() if len(items) > 1 else 0
+        if limit <= 1:
+            return [await func(item) for item in items]
+
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(item):
+            async with semaphore:
+                async with self.concurrent_scope():
+                    return await func(item)
+
+        return list(await asyncio.gather(*(run(item) for item in items)))
+
+    def _dump_plan(self):
+        """`self.fields`被替换(`_update_fields`)之后才重新生成"""
+        cached = self.__dict__.get("_dump_plan_cache")
+        if cached is None or cached[0] is not self.fields:
+            cached = self._dump_plan_cache = (self.fields, compile_dump_plan(self.fields, self.prefix))
+        return cached[1]
 
     async def _async_invoke_field_validators(self, unmarshal, data, many):
         """
@@ -49,9 +129,9 @@ class Schema(_Schema):
                 raise ValueError('"{0}" field does not exist.'.format(field_name))
 
             if many:
-                for idx, item in enumerate(data):
+                async def validate_item(idx):
                     try:
-                        value = item[field_obj.attribute or field_name]
+                        value = data[idx][field_obj.attribute or field_name]
                     except KeyError:
                         pass
                     else:
@@ -64,6 +144,8 @@ class Schema(_Schema):
                         )
                         if validated_value is missing:
                             data[idx].pop(field_name, None)
+
+                await self._async_map(validate_item, range(len(data)))
             else:
                 try:
                     value = data[field_obj.attribute or field_name]
@@ -104,13 +186,15 @@ class Schema(_Schema):
             if pass_many:
                 validator = functools.partial(validator, many=many)
             if many and not pass_many:
-                for idx, item in enumerate(data):
+                async def validate_item(idx):
                     try:
                         await unmarshal.async_run_validator(validator,
-                                                            item, original_data, self.fields, many=many,
+                                                            data[idx], original_data, self.fields, many=many,
                                                             index=idx, pass_original=pass_original)
                     except ValidationError as err:
                         errors.update(err.messages)
+
+                await self._async_map(validate_item, range(len(data)))
             else:
                 try:
                     await unmarshal.async_run_validator(validator,
@@ -156,10 +240,13 @@ class Schema(_Schema):
                     data = utils.if_none(await processor(data, many), data)
             elif many:
                 if pass_original:
-                    data = [utils.if_none(await processor(item, original_data), item)
-                            for item in data]
+                    async def process_item(item, processor=processor):
+                        return utils.if_none(await processor(item, original_data), item)
                 else:
-                    data = [utils.if_none(await processor(item), item) for item in data]
+                    async def process_item(item, processor=processor):
+                        return utils.if_none(await processor(item), item)
+
+                data = await self._async_map(process_item, data)
             else:
                 if pass_original:
                     data = utils.if_none(await processor(data, original_data), data)
@@ -294,6 +381,7 @@ class Schema(_Schema):
                     accessor=self.get_attribute or self.__accessor__,
                     dict_class=self.dict_class,
                     index_errors=self.opts.index_errors,
+                    plan=self._dump_plan(),
                     **kwargs
                 )
             except ValidationError as error:
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import aioredis
+import ujson
+
+from cat_and_dog.utils.request.response import dumps, make_etag, last_modified_of
+from cat_and_dog.utils.routing import primary
+from .lru import LRUCache
+
+
+class DetailCache:
+    """
+    详情接口的read-through缓存, 将`async_dump`的结果保存在redis中;
+    每个worker在redis之前还有一层进程内的LRU缓存, 写入数据时通过redis的pub/sub通知所有worker失效
+
+    # 伪代码
+    cache = DetailCache(app)
+
+    # 缓存未命中时才会查询数据库并dump
+    data = await cache.get_or_dump(Model, pk, schema)
+
+    # 同时返回ETag以及Last-Modified, 客户端的缓存有效时不需要序列化
+    entry = await cache.get_entry(Model, pk, schema)
+
+    # 修改数据之后, 使实例以及包含该实例的缓存失效
+    await cache.invalidate(await cache.related(instance))
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = 300
+        self.prefix = "detail:v2"
+        # 进程内缓存dump之后的数据
+        self.local = LRUCache()
+        # 进程内缓存热点模型实例的`__values__`, 如分类和品牌, 每次读取时创建新的实例
+        self.instances = LRUCache()
+        self.instance_tables = set()
+        self._subscriber = None
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.setdefault("DETAIL_CACHE_TTL", 300)
+        # 缓存的内容包括ETag以及Last-Modified, 与之前只保存数据的缓存使用不同的前缀
+        self.prefix = app.config.setdefault("DETAIL_CACHE_PREFIX", "detail:v2")
+        self.local = LRUCache(app.config.setdefault("LOCAL_CACHE_SIZE", 1024),
+                              app.config.setdefault("LOCAL_CACHE_TTL", 60))
+        self.instances = LRUCache(app.config["LOCAL_CACHE_SIZE"], app.config["LOCAL_CACHE_TTL"])
+        self.instance_tables = set(app.config.setdefault("LOCAL_CACHE_MODELS", ()))
+
+        @app.listener("after_server_start")
+        async def start_subscriber(app, loop):
+            self._subscriber = loop.create_task(self.subscribe())
+
+        @app.listener("before_server_stop")
+        async def stop_subscriber(app, loop):
+            if self._subscriber:
+                self._subscriber.cancel()
+
+    @property
+    def redis(self):
+        """`app.redis` is created when the server starts, the cache is disabled before that"""
+        return getattr(self.app, "redis", None)
+
+    @property
+    def channel(self) -> str:
+        return f"{self.prefix}:invalidate"
+
+    def key(self, model, pk) -> str:
+        return f"{self.prefix}:{model.__tablename__}:{pk}"
+
+    def stats(self) -> dict:
+        return {
+            "local": self.local.stats(),
+            "instances": self.instances.stats(),
+        }
+
+    async def get_or_dump(self, model, pk: int, schema) -> dict:
+        """
+        read the dumped data from the cache, query and dump the instance if missed
+        :param model:
+        :param pk:
+        :param schema: the detail schema used to dump the instance
+        :return: the dumped data
+        """
+        return (await self.get_entry(model, pk, schema))["data"]
+
+    async def get_entry(self, model, pk: int, schema) -> dict:
+        """
+        same as `get_or_dump`, but the validators are also returned
+        :return: {"data": dumped data, "etag": ETag, "last_modified": ISO datetime(UTC) or None}
+        """
+        key = self.key(model, pk)
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+
+        redis = self.redis
+        if redis is not None:
+            cached = await redis.get(key)
+            if cached is not None:
+                entry = ujson.loads(cached)
+                self.local.set(key, entry)
+                return entry
+
+        # 从主库读取, 避免将副本中过期的数据写入缓存
+        with primary():
+            instance = await model.get_or_404(pk)
+            data, error = await schema.async_dump(instance)
+
+        last_modified = last_modified_of(data)
+        entry = {
+            "data": data,
+            "etag": make_etag(dumps(data)),
+            "last_modified": last_modified and last_modified.isoformat(),
+        }
+        if redis is not None:
+            await redis.set(key, ujson.dumps(entry), expire=self.ttl)
+        self.local.set(key, entry)
+        return entry
+
+    async def get_instance(self, model, pk: int, loader):
+        """
+        `LOCAL_CACHE_MODELS`中的模型实例缓存在进程内, 其他模型直接调用loader
+        :param model:
+        :param pk:
+        :param loader: async function to load the instance if missed
+        :return: instance or None
+        """
+        if model.__tablename__ not in self.instance_tables:
+            return await loader()
+
+        key = self.key(model, pk)
+        values = self.instances.get(key)
+        if values is not None:
+            return model.from_values(values)
+
+        with primary():
+            instance = await loader()
+        if instance is not None:
+            self.instances.set(key, dict(instance.__values__))
+        return instance
+
+    @staticmethod
+    async def related(instance, old_values: dict = None) -> set:
+        """
+        找出dump结果中包含该实例的所有缓存:
+            - 实例本身
+            - many2one的一方(parent), 其`children`, `skus`等列表中包含了该实例
+            - one2many的一方(children), 其`parent`, `spu`等字段包含了该实例
+
+        删除实例时应该在删除之前调用, 否则无法找到children
+
+        :param instance:
+        :param old_values: 更新之前的`__values__`, 原来的parent也会失效
+        :return: {(model, pk)}
+        """
+        model = type(instance)
+        items = {(model, instance.id)}
+
+        for name in model.__rel__:
+            relationship = getattr(model, name)
+            relationship.resolve(model)
+            related_model = relationship.related_model
+
+            if relationship.relation in ("many2one", "one2one"):
+                pks = {getattr(instance, relationship.fk)}
+                if old_values:
+                    pks.add(old_values.get(relationship.fk))
+                items.update((related_model, pk) for pk in pks if pk is not None)
+            elif relationship.relation == "one2many":
+                rows = await related_model.select("id"). \
+                    where(getattr(related_model, relationship.fk) == instance.id).gino.all()
+                items.update((related_model, r[0]) for r in rows)
+
+        return items
+
+    @staticmethod
+    async def related_rows(model, rows) -> set:
+        """
+        批量版本的`related`, 用于批量写入之后
+
+        :param model:
+        :param rows: 包含`id`以及many2one外键的行, 写入之前和之后的行都应该传入
+        :return: {(model, pk)}
+        """
+        ids = {row["id"] for row in rows}
+        items = {(model, pk) for pk in ids}
+
+        for name in model.__rel__:
+            relationship = getattr(model, name)
+            relationship.resolve(model)
+            related_model = relationship.related_model
+
+            if relationship.relation in ("many2one", "one2one"):
+                items.update((related_model, row[relationship.fk]) for row in rows
+                             if row[relationship.fk] is not None)
+            elif relationship.relation == "one2many" and ids:
+                children = await related_model.select("id"). \
+                    where(getattr(related_model, relationship.fk).in_(ids)).gino.all()
+                items.update((related_model, r[0]) for r in children)
+
+        return items
+
+    def discard(self, keys) -> None:
+        """remove the keys from the caches of this worker"""
+        for key in keys:
+            self.local.pop(key)
+            self.instances.pop(key)
+
+    async def invalidate(self, items) -> None:
+        """
+        invalidate the caches of all workers
+        :param items: {(model, pk)}
+        """
+        if not items:
+            return
+
+        keys = list({self.key(model, pk) for model, pk in items})
+        self.discard(keys)
+
+        redis = self.redis
+        if redis is None:
+            return
+        await redis.delete(*keys)
+        await redis.publish(self.channel, ujson.dumps(keys))
+
+    async def subscribe(self) -> None:
+        """subscribe the invalidation sent by other workers, it runs until the server stops"""
+        while True:
+            try:
+                conn = await aioredis.create_redis(self.app.config["REDIS"])
+            except (OSError, aioredis.RedisError):
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                channel, = await conn.subscribe(self.channel)
+                # 连接断开期间的失效通知会丢失, 因此每次(重新)订阅之后清空进程内的缓存
+                self.local.clear()
+                self.instances.clear()
+                async for message in channel.iter(encoding="utf-8"):
+                    self.discard(ujson.loads(message))
+            except aioredis.RedisError:
+                await asyncio.sleep(1)
+            finally:
+                conn.close()
+                await conn.wait_closed()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """
+    进程内的LRU缓存, 超过`maxsize`时淘汰最久未使用的值, 超过`ttl`秒的值视为过期
+
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.get("a")  # 1
+    cache.stats()   # {"size": 1, "hits": 1, "misses": 0, "evictions": 0}
+    """
+
+    __slots__ = ("maxsize", "ttl", "_data", "hits", "misses", "evictions")
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        """不影响命中率的统计, 也不改变淘汰的顺序"""
+        item = self._data.get(key)
+        return item is not None and item[1] >= monotonic()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        value, expire_at = item
+        if expire_at < monotonic():
+            del self._data[key]
+            self.misses += 1
+            self.evictions += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    # 作为sqlalchemy的`compiled_cache`使用
+    __setitem__ = set
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item and item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class CompiledCache(LRUCache):
+    """
+    sqlalchemy的`compiled_cache`, 只缓存标记了`execution_options(shaped=True)`的语句(见`MixInBase.shape_statement`)
+
+    sqlalchemy以语句对象为key, 其他语句每次都是新的对象, 缓存之后不会再命中, 只会淘汰可以复用的语句并且拉低命中率
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def is_shaped(key) -> bool:
+        # key: (dialect, statement, 参数名, 是否executemany)
+        options = getattr(key[1], "_execution_options", None) or {}
+        return options.get("shaped", False)
+
+    def get(self, key, default=None):
+        if not self.is_shaped(key):
+            return default
+        return super().get(key, default)
+
+    def set(self, key, value):
+        if self.is_shaped(key):
+            super().set(key, value)
+
+    __setitem__ = set
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from datetime import date, datetime
+
+import ujson
+from sqlalchemy import Date, DateTime
+
+from cat_and_dog.utils.routing import primary
+from .lru import LRUCache
+
+
+class UserCache:
+    """
+    登录用户的缓存, 避免每个请求都查询一次用户表;
+    进程内的LRU缓存在redis之前, 其他worker的进程内缓存最多在`USER_CACHE_LOCAL_TTL`秒之后失效;
+    缓存中只保存`__values__`, 每次读取都返回新的实例
+
+    # 伪代码
+    cache = UserCache(app)
+
+    user = await cache.get(User, user_id)
+
+    # 修改用户之后
+    await cache.invalidate(User, user_id)
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = 60
+        self.prefix = "user"
+        self.local = LRUCache(maxsize=1024, ttl=5)
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.setdefault("USER_CACHE_TTL", 60)
+        self.prefix = app.config.setdefault("USER_CACHE_PREFIX", "user")
+        self.local = LRUCache(app.config.setdefault("USER_CACHE_SIZE", 1024),
+                              app.config.setdefault("USER_CACHE_LOCAL_TTL", 5))
+
+    @property
+    def redis(self):
+        """`app.redis` is created when the server starts, only the local cache is used before that"""
+        return getattr(self.app, "redis", None)
+
+    def key(self, model, pk) -> str:
+        return f"{self.prefix}:{model.__tablename__}:{pk}"
+
+    def stats(self) -> dict:
+        return self.local.stats()
+
+    @staticmethod
+    def dumps(values: dict) -> str:
+        return ujson.dumps({k: v.isoformat() if isinstance(v, (date, datetime)) else v for k, v in values.items()})
+
+    @staticmethod
+    def loads(model, cached) -> dict:
+        values = ujson.loads(cached)
+        for column in model.__table__.columns:
+            value = values.get(column.name)
+            if value is None:
+                continue
+            if isinstance(column.type, DateTime):
+                values[column.name] = datetime.fromisoformat(value)
+            elif isinstance(column.type, Date):
+                values[column.name] = date.fromisoformat(value)
+        return values
+
+    async def get(self, model, pk: int):
+        """
+        read the user from the cache, query it from the primary if missed
+        :param model: the user model
+        :param pk:
+        :return: instance or None
+        """
+        key = self.key(model, pk)
+        values = self.local.get(key)
+        if values is not None:
+            return model.from_values(values)
+
+        redis = self.redis
+        if redis is not None:
+            cached = await redis.get(key)
+            if cached is not None:
+                values = self.loads(model, cached)
+                self.local.set(key, values)
+                return model.from_values(values)
+
+        with primary():
+            user = await model.get(pk)
+        if user is None:
+            return None
+
+        values = dict(user.__values__)
+        if redis is not None:
+            await redis.set(key, self.dumps(values), expire=self.ttl)
+        self.local.set(key, values)
+        return user
+
+    async def invalidate(self, model, pk: int) -> None:
+        key = self.key(model, pk)
+        self.local.pop(key)
+        redis = self.redis
+        if redis is not None:
+            await redis.delete(key)
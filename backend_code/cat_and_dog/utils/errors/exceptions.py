@@ -23,3 +23,5 @@ class SchemaException(Exception):
 
 
 LOGIN_ERROR = ApiException("用户名或密码不正确", UNAUTHORIZED)
+TREE_TOO_DEEP = ApiException("分类树的深度超过了限制", SERVER_ERROR)
+TOO_MANY_LOGINS = ApiException("登录请求过多, 请稍后再试", TOO_MANY_REQUESTS)
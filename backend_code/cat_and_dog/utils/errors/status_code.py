@@ -14,6 +14,7 @@ BAD_REQUEST = 400
 UNAUTHORIZED = 401
 FORBIDDEN = 403
 NOT_FOUND = 404
+TOO_MANY_REQUESTS = 429
 
 # 500
 SERVER_ERROR = 500
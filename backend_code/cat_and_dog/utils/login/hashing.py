@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from cat_and_dog.utils.errors.exceptions import TOO_MANY_LOGINS
+
+
+class PasswordHasher:
+    """
+    在executor中计算密码的hash, 避免阻塞event loop;
+    同时计算的数量不超过`PASSWORD_HASH_CONCURRENCY`, 等待以及正在计算的数量超过`PASSWORD_HASH_QUEUE`时直接返回429
+
+    pbkdf2以及scrypt在计算时会释放GIL, 默认使用线程池; `PASSWORD_HASH_EXECUTOR = "process"`时使用进程池
+
+    # 伪代码
+    hasher = PasswordHasher(app)
+
+    password_hash = await hasher.hash("password")
+    is_success = await hasher.check(password_hash, "password")
+    if is_success and hasher.needs_rehash(password_hash):
+        password_hash = await hasher.hash("password")
+    """
+
+    def __init__(self, app=None):
+        # werkzeug的method, 如"scrypt:32768:8:1", "pbkdf2:sha256:600000"
+        self.method = "scrypt"
+        self.salt_length = 16
+        self.concurrency = 2
+        self.max_waiting = 32
+        self.executor = None
+        self._limiter = None
+        self._waiting = 0
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.setdefault("PASSWORD_HASH_METHOD", "scrypt")
+        self.salt_length = app.config.setdefault("PASSWORD_HASH_SALT_LENGTH", 16)
+        self.concurrency = app.config.setdefault("PASSWORD_HASH_CONCURRENCY", 2)
+        self.max_waiting = app.config.setdefault("PASSWORD_HASH_QUEUE", 32)
+        executor_type = app.config.setdefault("PASSWORD_HASH_EXECUTOR", "thread")
+
+        # 进程池需要在每个worker启动之后创建
+        @app.listener("after_server_start")
+        async def start_executor(app, loop):
+            executor_class = ProcessPoolExecutor if executor_type == "process" else ThreadPoolExecutor
+            self.executor = executor_class(max_workers=self.concurrency)
+
+        @app.listener("before_server_stop")
+        async def stop_executor(app, loop):
+            executor, self.executor = self.executor, None
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @property
+    def limiter(self) -> asyncio.Semaphore:
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.concurrency)
+        return self._limiter
+
+    async def run(self, func, *args):
+        """run the hash function in the executor, raise `TOO_MANY_LOGINS` if the queue is full"""
+        if self._waiting >= self.max_waiting:
+            raise TOO_MANY_LOGINS
+
+        self._waiting += 1
+        try:
+            async with self.limiter:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self._waiting -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(partial(generate_password_hash, method=self.method, salt_length=self.salt_length),
+                              password)
+
+    async def check(self, password_hash: str, password: str) -> bool:
+        return await self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """
+        保存的hash是否使用了其他的method, 如: 修改`PASSWORD_HASH_METHOD`之后旧的hash
+
+        werkzeug会补全method的默认参数("scrypt" -> "scrypt:32768:8:1"),
+        配置中没有给出的参数不做比较, 需要升级参数时配置完整的method
+        """
+        method = password_hash.split("$", 1)[0]
+        return method != self.method and not method.startswith(self.method + ":")
+
+    def stats(self) -> dict:
+        return {"concurrency": self.concurrency, "waiting": self._waiting}
@@ -3,29 +3,37 @@
 
 class LoginRequest:
     """the login request
+
+    the user is loaded lazily, only the apis which need the user(such as `login_required`) will query it:
+
+        user = await request.load_user()
     """
     _user = None
     login_manager: 'LoginManager'
 
     async def load_user(self):
-        """every time the request"""
+        """load the user at the first time, then return the loaded one"""
+        if self._user is not None:
+            return self._user
+
         if self.login_manager.user_callback is None:
             raise Exception("set the `user_loader` first")
 
-        user = self.login_manager.ambiguous_class
-        if self._user is None:
-            user_id = self.session.get("user_id")
-            if user_id:
-                user = await self.login_manager.user_callback(user_id)
+        user = None
+        user_id = self.session.get("user_id")
+        if user_id:
+            user = await self.login_manager.user_callback(user_id)
 
-        self._user = self.login_manager.ambiguous_class() if user is self.login_manager.ambiguous_class else user
+        self._user = self.login_manager.ambiguous_class() if user is None else user
         return self._user
 
     @property
     def user(self):
-        """实现request的User"""
+        """实现request的User, 未登录的请求不需要`load_user`"""
         if self._user is None:
-            assert "must await `load_user` before access to user"
+            if self.session.get("user_id"):
+                raise Exception("must await `load_user` before access to user")
+            self._user = self.login_manager.ambiguous_class()
         return self._user
 
     @property
@@ -34,12 +42,16 @@ class LoginRequest:
 
     def login(self, user):
         self.session["user_id"] = user.id
+        self._user = user
 
-    def logout(self):
-        user = self.user
-        if user.is_ambiguous:
-            return
-        try:
-            self.session.pop("user_id")
-        except KeyError:
-            pass
+    @property
+    def session_interface(self):
+        return self.app.ctx.extensions["session"].interface
+
+    async def logout(self):
+        """签名的session同时吊销原来的token, 见`SignedSessionInterface.revoke_session`"""
+        self.session.pop("user_id", None)
+        revoke_session = getattr(self.session_interface, "revoke_session", None)
+        if revoke_session is not None:
+            await revoke_session(self.session)
+        self._user = None
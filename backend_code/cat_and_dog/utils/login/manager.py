@@ -19,19 +19,7 @@ class LoginManager:
 
         app.request_class = login_class
 
-        # the hook must register `after` session
-        # Sanic-Session will not `appendleft` the session function
-        # into the request_middleware until the app has been fully inited.
-        app.request_middleware.appendleft(self.get_current_user)
-
     def user_loader(self, callback):
         """callback is an async function"""
         self.user_callback = callback
         return callback
-
-    @staticmethod
-    async def get_current_user(request):
-        """load user, make request.user available;
-        consider CACHE?
-        """
-        await request.load_user()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import hashlib
+import hmac
+import time
+import uuid
+
+import aioredis
+import ujson
+from sanic_session.base import BaseSessionInterface, SessionDict, get_request_container
+
+try:
+    from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+except ImportError:
+    Fernet = MultiFernet = None
+    InvalidToken = ValueError
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SignedSessionInterface(BaseSessionInterface):
+    """
+    session保存在签名的cookie(或`Authorization: Bearer <token>`)中, 不需要每个请求都读写redis
+
+    token: `payload.kid.signature`, payload中包含session的数据, `sid`以及过期时间`exp`
+        - keys: 签名的密钥, 第一个用于签名, 其他的只用于验证, 轮换密钥时将新的密钥放在最前面
+        - encrypt: 使用Fernet加密payload, 需要安装`cryptography`
+        - redis: 只有登出的token会写入吊销列表, 在过期之前都是无效的;
+          每个worker在进程内保存一份吊销列表, 通过redis的pub/sub同步, 验证token时不需要访问redis,
+          订阅断开期间的吊销会在重新订阅之后全部重新加载;
+          登出时调用`revoke_session`, 即使session中还有其他数据, 原来的token也不能再使用
+
+    没有cookie并且没有修改session的请求不会有任何IO, 也不会设置cookie
+
+    `open`以及`save`都已经重写, 基类中读写服务端存储的`_get_value`, `_set_value`, `_delete_key`不会被调用,
+    只是空的实现
+    """
+
+    def __init__(
+        self,
+        redis,
+        keys,
+        encrypt: bool = False,
+        domain: str = None,
+        expiry: int = 2592000,
+        httponly: bool = True,
+        cookie_name: str = "session",
+        prefix: str = "session:revoked:",
+        sessioncookie: bool = False,
+        samesite: str = None,
+        session_name: str = "session",
+        secure: bool = False,
+    ):
+        if not keys:
+            raise RuntimeError("`SESSION_KEYS` is required by the signed session")
+        if encrypt and Fernet is None:
+            raise RuntimeError("Please install cryptography to encrypt the session: pip install cryptography")
+
+        self.redis = redis
+        # 进程内的吊销列表, {sid: 过期时间}
+        self.revoked = dict()
+        self._subscriber = None
+        self.keys = [key.encode() if isinstance(key, str) else key for key in keys]
+        self.kids = {self.kid(key): key for key in self.keys}
+        self.fernet = MultiFernet([Fernet(self.fernet_key(key)) for key in self.keys]) if encrypt else None
+
+        super().__init__(
+            expiry=expiry,
+            prefix=prefix,
+            cookie_name=cookie_name,
+            domain=domain,
+            httponly=httponly,
+            sessioncookie=sessioncookie,
+            samesite=samesite,
+            session_name=session_name,
+            secure=secure,
+        )
+
+    @property
+    def channel(self) -> str:
+        return f"{self.prefix}channel"
+
+    def start(self, loop, address: str) -> None:
+        """start syncing the revocation list, it runs until `stop`"""
+        self._subscriber = loop.create_task(self.subscribe(address))
+
+    def stop(self) -> None:
+        if self._subscriber:
+            self._subscriber.cancel()
+
+    async def revoke(self, sid: str, exp: int = None) -> None:
+        """
+        吊销sid, 在过期之前携带该sid的token都无效, 并通知所有worker
+        :param sid:
+        :param exp: token的过期时间, 默认为现在签发的token的过期时间(最晚的过期时间)
+        """
+        exp = int(exp or time.time() + self.expiry)
+        remain = exp - int(time.time())
+        if remain <= 0:
+            return
+
+        self.revoked[sid] = exp
+        await self.redis.set(self.prefix + sid, exp, expire=remain)
+        await self.redis.publish(self.channel, ujson.dumps({"sid": sid, "exp": exp}))
+
+    async def revoke_session(self, session_dict: SessionDict) -> None:
+        """吊销当前请求的token, 响应中使用新的sid签发session中剩余的数据, 没有数据时删除cookie"""
+        if session_dict.exp:
+            await self.revoke(session_dict.sid, session_dict.exp)
+        session_dict.sid = uuid.uuid4().hex
+        session_dict.exp = 0
+        session_dict.modified = True
+
+    def is_revoked(self, sid: str) -> bool:
+        exp = self.revoked.get(sid)
+        if exp is None:
+            return False
+        if exp < time.time():
+            del self.revoked[sid]
+            return False
+        return True
+
+    async def load_revoked(self) -> None:
+        """重新加载redis中的全部吊销列表"""
+        keys = [key async for key in self.redis.iscan(match=self.prefix + "*")]
+        revoked = dict()
+        if keys:
+            values = await self.redis.mget(*keys)
+            prefix_length = len(self.prefix)
+            revoked.update((key.decode()[prefix_length:], int(value)) for key, value in zip(keys, values) if value)
+        self.revoked = revoked
+
+    async def subscribe(self, address: str) -> None:
+        while True:
+            try:
+                conn = await aioredis.create_redis(address)
+            except (OSError, aioredis.RedisError):
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                channel, = await conn.subscribe(self.channel)
+                # 订阅之后再加载, 加载期间的吊销也不会丢失
+                await self.load_revoked()
+                async for message in channel.iter(encoding="utf-8"):
+                    message = ujson.loads(message)
+                    self.revoked[message["sid"]] = message["exp"]
+            except aioredis.RedisError:
+                await asyncio.sleep(1)
+            finally:
+                conn.close()
+                await conn.wait_closed()
+
+    @staticmethod
+    def kid(key: bytes) -> str:
+        """密钥的标识, 轮换密钥时可以直接找到签名的密钥"""
+        return hashlib.sha256(key).hexdigest()[:8]
+
+    @staticmethod
+    def fernet_key(key: bytes) -> bytes:
+        return base64.urlsafe_b64encode(hashlib.sha256(b"session-encrypt:" + key).digest())
+
+    @staticmethod
+    def sign(key: bytes, message: bytes) -> str:
+        return _b64encode(hmac.new(key, message, hashlib.sha256).digest())
+
+    def dumps(self, data: dict) -> str:
+        payload = ujson.dumps(data).encode()
+        payload = self.fernet.encrypt(payload).decode() if self.fernet else _b64encode(payload)
+
+        key = self.keys[0]
+        message = f"{payload}.{self.kid(key)}"
+        return f"{message}.{self.sign(key, message.encode())}"
+
+    def loads(self, token: str):
+        """
+        验证token
+        :param token:
+        :return: (data, 是否需要使用当前的密钥重新签名), token无效或过期时data为None
+        """
+        try:
+            payload, kid, signature = token.rsplit(".", 2)
+        except ValueError:
+            return None, False
+
+        key = self.kids.get(kid)
+        if key is None or not hmac.compare_digest(signature, self.sign(key, f"{payload}.{kid}".encode())):
+            return None, False
+
+        try:
+            payload = self.fernet.decrypt(payload.encode()) if self.fernet else _b64decode(payload)
+            data = ujson.loads(payload)
+        except (ValueError, InvalidToken):
+            return None, False
+
+        if not isinstance(data, dict) or data.get("exp", 0) < time.time():
+            return None, False
+        return data, key is not self.keys[0]
+
+    def _get_token(self, request):
+        token = request.cookies.get(self.cookie_name)
+        if not token:
+            authorization = request.headers.get("Authorization", "")
+            if authorization.startswith("Bearer "):
+                token = authorization[len("Bearer "):]
+        return token
+
+    async def open(self, request) -> SessionDict:
+        token = self._get_token(request)
+        data, rotate = self.loads(token) if token else (None, False)
+
+        if data is not None and self.is_revoked(data["sid"]):
+            data = None
+
+        if data is None:
+            session_dict = SessionDict(sid=uuid.uuid4().hex)
+            session_dict.exp = 0
+            # 无效的cookie需要删除
+            session_dict.modified = bool(token)
+        else:
+            sid, exp = data.pop("sid"), data.pop("exp")
+            session_dict = SessionDict(data, sid=sid)
+            session_dict.exp = exp
+            # 使用旧的密钥签名, 或者超过一半有效期的token重新签发
+            session_dict.modified = rotate or exp - time.time() < self.expiry / 2
+
+        req = get_request_container(request)
+        req[self.session_name] = session_dict
+        return session_dict
+
+    async def save(self, request, response) -> None:
+        req = get_request_container(request)
+        session_dict = req.get(self.session_name)
+        if session_dict is None or not session_dict.modified:
+            return
+
+        if not session_dict:
+            # session被清空, 原来的token在过期之前都加入吊销列表
+            if session_dict.exp:
+                await self.revoke(session_dict.sid, session_dict.exp)
+            self._delete_cookie(request, response)
+            return
+
+        response.cookies[self.cookie_name] = self.dumps({
+            **session_dict,
+            "sid": session_dict.sid,
+            "exp": int(time.time()) + self.expiry,
+        })
+        self._set_cookie_props(request, response)
+
+    def _set_cookie_props(self, request, response):
+        token = response.cookies[self.cookie_name].value
+        super()._set_cookie_props(request, response)
+        # the base class sets the sid as the cookie value
+        response.cookies[self.cookie_name] = token
+
+    def _delete_cookie(self, request, response):
+        super()._delete_cookie(request, response)
+        response.cookies[self.cookie_name] = ""
+
+    async def _get_value(self, prefix: str, sid: str):
+        """the session is stored in the token, there is no server side value"""
+        return None
+
+    async def _delete_key(self, key: str):
+        pass
+
+    async def _set_value(self, key: str, data: SessionDict):
+        pass
@@ -8,11 +8,13 @@ def login_validator(validator):
     def method_compact(wrapper):
         @functools.wraps(wrapper)
         async def method_wrapper(self, request, *args, **kwargs):
+            await request.load_user()
             validator(request)
             return await wrapper(self, request, *args, **kwargs)
 
         @functools.wraps(wrapper)
         async def function_wrapper(request, *args, **kwargs):
+            await request.load_user()
             validator(request)
             return await wrapper(request, *args, **kwargs)
 
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from time import monotonic
+
+from gino.dialects.asyncpg import Pool
+
+
+class PoolMetrics:
+    """从连接池获取连接的次数以及等待的时间"""
+
+    __slots__ = ("acquired", "timeouts", "wait_time", "max_wait")
+
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waited: float):
+        self.acquired += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.wait_time / self.acquired * 1000, 3) if self.acquired else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredPool(Pool):
+    """
+    记录等待时间的asyncpg连接池, `Gino.init_app`中默认使用, 相当于配置:
+
+        DB_KWARGS = dict(pool_class=MeteredPool)
+    """
+
+    async def acquire(self, *, timeout=None):
+        start = monotonic()
+        try:
+            conn = await super().acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        pool_metrics.record(monotonic() - start)
+        return conn
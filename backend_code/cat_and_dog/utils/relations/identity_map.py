@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from contextvars import ContextVar
+
+_identity_map = ContextVar("identity_map", default=None)
+
+
+class IdentityMap:
+    """
+    请求级别的identity map, 在同一个请求中, 每个`(model, id)`只会被实例化一次
+
+    # 伪代码
+    IdentityMap().bind()
+
+    a = await Categories.get(1)
+    b = await Categories.get(1)  # 不会再查询数据库
+
+    assert a is b
+    """
+
+    __slots__ = ("_instances",)
+
+    def __init__(self):
+        self._instances = dict()
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __contains__(self, item):
+        return item in self._instances
+
+    def bind(self):
+        """bind the identity map to the current context(i.e. the current request)"""
+        return _identity_map.set(self)
+
+    @staticmethod
+    def unbind(token):
+        """restore the identity map bound before `bind` returned the token"""
+        _identity_map.reset(token)
+
+    def get(self, model, pk):
+        return self._instances.get((model, pk))
+
+    def add(self, instance):
+        """
+        add the instance into the map
+        :return: the instance already in the map or the given instance
+        """
+        return self._instances.setdefault((type(instance), instance.id), instance)
+
+    def discard(self, model, pk):
+        self._instances.pop((model, pk), None)
+
+    def clear(self):
+        self._instances.clear()
+
+
+def current_identity_map() -> IdentityMap or None:
+    """the identity map of the current request, None if there is no one"""
+    return _identity_map.get()
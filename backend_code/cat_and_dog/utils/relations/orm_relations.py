@@ -3,18 +3,39 @@
 from functools import partial
 from reprlib import repr
 
+from gino.crud import Alias
 from gino.declarative import Model
 from gino.loader import ModelLoader
-from sqlalchemy import and_, select
+from sqlalchemy import and_, select, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from cat_and_dog.utils.empty import Empty
 from .exception import RelationException
+from .identity_map import current_identity_map
+
+
+def any_of(column, values):
+    """
+    `column = ANY($1)`, 所有的值作为一个数组参数
+
+    与`IN ($1, $2, ...)`不同, 无论有多少个值生成的SQL都是相同的, asyncpg可以复用prepared statement
+    """
+    return column == any_(bindparam(None, list(values), type_=ARRAY(column.type)))
 
 
 def _do_load(self, row):
     values = dict((c.name, row[c]) for c in self.columns if c in row)
     if all((v is None) for v in values.values()):
         return None
+
+    # only the instance with all columns loaded can be shared in the identity map
+    identity_map = None if isinstance(self.columns, list) else current_identity_map()
+    if identity_map is not None:
+        model = self.model.model if isinstance(self.model, Alias) else self.model
+        instance = identity_map.get(model, values.get("id"))
+        if instance is not None:
+            return instance
+
     rv = self.model()
     for c in self.columns:
         if c in row:
@@ -25,6 +46,9 @@ def _do_load(self, row):
     # set the relation automatically
     rv.init_the_relation()
 
+    if identity_map is not None and rv.id is not None:
+        identity_map.add(rv)
+
     return rv
 
 
@@ -53,6 +77,37 @@ class RelationMixin:
     def __str__(self):
         return f"<{self.__class__.__name__}-{self.id}>"
 
+    @classmethod
+    async def get(cls, ident, *args, **kwargs):
+        """
+        the instance which has been loaded in the current request
+        will be returned directly, see `IdentityMap`
+        """
+        identity_map = current_identity_map()
+        if identity_map is None:
+            return await super().get(ident, *args, **kwargs)
+
+        instance = identity_map.get(cls, ident)
+        if instance is None:
+            instance = await super().get(ident, *args, **kwargs)
+            # the instance may come from a cache rather than the loader
+            if instance is not None:
+                instance = identity_map.add(instance)
+        return instance
+
+    @classmethod
+    def from_values(cls, values: dict):
+        """
+        使用缓存的`__values__`创建新的实例, 缓存中不保存实例本身, 避免多个请求修改同一个实例
+
+            values = dict(instance.__values__)
+            copy = Model.from_values(values)
+        """
+        instance = cls()
+        instance.__values__.update(values)
+        instance.init_the_relation()
+        return instance
+
     def __await__(self):
         """query for all relations"""
 
@@ -226,12 +281,11 @@ class RelationShip:
             raise Exception(f"can't find secondary model {name}")
         return model_to_find
 
-    def __call__(self, instance, local_variable_name) -> 'RelationalParent' or 'RelationalChildren':
+    def resolve(self, model):
         """
-        - many2one return an instance of parent
-        - one2many return a list-like of children
-        - many2many return a list-like of relations(like one2many)
-        - one2one return an instance of parent(like many2one)
+        find the related model and the foreign key,
+        it should be called before the relation is used
+        :param model: the model(or an instance of the model) which holds the relation
         """
         if not self.is_find_model:
             # related_model must been found here because the base has't been fully inited until now
@@ -242,7 +296,16 @@ class RelationShip:
 
         if not self.is_find_foreign:
             self.is_find_foreign = True
-            self.figure_out_fk(instance)
+            self.figure_out_fk(model)
+
+    def __call__(self, instance, local_variable_name) -> 'RelationalParent' or 'RelationalChildren':
+        """
+        - many2one return an instance of parent
+        - one2many return a list-like of children
+        - many2many return a list-like of relations(like one2many)
+        - one2one return an instance of parent(like many2one)
+        """
+        self.resolve(instance)
 
         if self.relation in ("many2one", "one2one"):
             return RelationalParent(self.related_model, instance, self.fk, variable=local_variable_name)
@@ -252,6 +315,82 @@ class RelationShip:
             return RelationalChildren(self.related_model, instance, self.fk,
                                       secondary=self.secondary, secondary_fk=self.secondary_fk)
 
+    async def prefetch(self, instances: list, local_variable_name: str) -> None:
+        """
+        load the relation of all instances with one `IN (...)` query,
+        relations which have been loaded will be skipped
+
+        - many2one/one2one: `SELECT * FROM related WHERE id = ANY($1)`
+        - one2many: `SELECT * FROM related WHERE fk = ANY($1)`
+        - many2many: `SELECT related.*, secondary.fk FROM related JOIN secondary ... WHERE secondary.fk = ANY($1)`
+
+        :param instances: instances of the same model
+        :param local_variable_name: the name of the relation in the model
+        """
+        self.resolve(type(instances[0]))
+
+        if self.relation in ("many2one", "one2one"):
+            pending = [i for i in instances if isinstance(getattr(i, local_variable_name), RelationalParent)]
+            ids = {getattr(i, self.fk) for i in pending} - {None}
+            parents = dict()
+            if ids:
+                rows = await self.related_model.query.where(any_of(self.related_model.id, ids)).gino.all()
+                parents = {r.id: r for r in rows}
+            for i in pending:
+                setattr(i, local_variable_name, parents.get(getattr(i, self.fk)))
+            return
+
+        pending = [i for i in instances if getattr(i, local_variable_name).children is Empty]
+        ids = {i.id for i in pending}
+        if not ids:
+            return
+
+        if self.relation == "one2many":
+            owner = getattr(self.related_model, self.fk)
+            rows = await self.related_model.query.where(any_of(owner, ids)).gino.all()
+            rows = [(r, getattr(r, self.fk)) for r in rows]
+        else:
+            owner = getattr(self.secondary, self.fk)
+            query = self.related_model.join(
+                self.secondary, self.related_model.id == getattr(self.secondary, self.secondary_fk)
+            ).select().where(any_of(owner, ids))
+            rows = await query.gino.load((self.related_model, owner)).all()
+
+        children = dict()
+        for child, owner_id in rows:
+            children.setdefault(owner_id, []).append(child)
+        for i in pending:
+            getattr(i, local_variable_name).children = children.get(i.id, [])
+
+
+async def prefetch_relations(instances: list, names) -> None:
+    """
+    批量加载relation, 每个relation只执行一次查询, 而不是每个实例查询一次
+
+    # 伪代码
+    instances = await Model.query.gino.all()
+
+    await prefetch_relations(instances, ("parent", "children"))  # 2 queries
+
+    instances[0].parent  # 已经加载
+    instances[0].children  # 已经加载
+
+    :param instances: list of instances, they should be the same model
+    :param names: names of the relations to load
+    """
+    instances = [i for i in instances if i is not None]
+    if not instances:
+        return
+
+    model = type(instances[0])
+    for name in names:
+        relationship = getattr(model, name)
+        for i in instances:
+            # the relation of a new created instance may not be inited
+            if getattr(i, name) is relationship:
+                setattr(i, name, relationship(i, name))
+        await relationship.prefetch(instances, name)
+
 
 class RelationalChildren:
     """
@@ -354,7 +493,7 @@ class RelationalChildren:
 
 
 class RelationalParent:
-    __slots__ = ("model", "instance", "_where", "variable")
+    __slots__ = ("model", "instance", "_where", "variable", "pk")
 
     def __init__(self,
                  model: 'Model',
@@ -364,10 +503,12 @@ class RelationalParent:
         self.model = model
         self.instance = instance
         self.variable = variable
-        self._where = (getattr(model, "id") == getattr(instance, fk))
+        self.pk = getattr(instance, fk)
+        self._where = (getattr(model, "id") == self.pk)
 
     async def set_parent(self):
-        res = await self.model.query.where(self._where).gino.first()
+        # `Model.get` looks up the identity map of the request first
+        res = await self.model.get(self.pk) if self.pk is not None else None
         setattr(self.instance, self.variable, res)
         return res
 
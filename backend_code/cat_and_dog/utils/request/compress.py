@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+from sanic.response import HTTPResponse
+
+from cat_and_dog.utils.cache.lru import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """`gzip, br;q=0.8, *;q=0` -> {"gzip": 1.0, "br": 0.8, "*": 0.0}"""
+    encodings = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name] = q
+    return encodings
+
+
+class Compress:
+    """
+    按照`Accept-Encoding`压缩响应, 支持gzip, 安装了`brotli`/`zstandard`时优先使用br/zstd
+
+        - 小于`COMPRESS_MIN_SIZE`的响应不压缩
+        - 大于`COMPRESS_EXECUTOR_SIZE`的响应在线程池中压缩, 避免阻塞event loop
+        - 带有ETag的响应(如详情缓存)以`(ETag, encoding)`缓存压缩之后的结果, 相同的内容只压缩一次
+
+    # 伪代码
+    compress = Compress(app)
+    """
+
+    def __init__(self, app=None):
+        self.min_size = 1024
+        self.executor_size = 64 * 1024
+        self.level = 6
+        self.mimetypes = {"application/json", "application/x-ndjson", "text/html", "text/plain"}
+        self.cache = LRUCache(maxsize=256, ttl=300)
+        self.executor = None
+        self.compressors = self.available_compressors(self.level)
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.min_size = app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+        self.executor_size = app.config.setdefault("COMPRESS_EXECUTOR_SIZE", 64 * 1024)
+        self.level = app.config.setdefault("COMPRESS_LEVEL", 6)
+        self.mimetypes = set(app.config.setdefault("COMPRESS_MIMETYPES", self.mimetypes))
+        self.cache = LRUCache(app.config.setdefault("COMPRESS_CACHE_SIZE", 256),
+                              app.config.setdefault("COMPRESS_CACHE_TTL", 300))
+        self.compressors = self.available_compressors(self.level)
+
+        @app.listener("after_server_start")
+        async def start_executor(app, loop):
+            self.executor = ThreadPoolExecutor(max_workers=app.config.setdefault("COMPRESS_WORKERS", 2),
+                                               thread_name_prefix="compress")
+
+        @app.listener("before_server_stop")
+        async def stop_executor(app, loop):
+            executor, self.executor = self.executor, None
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+        # 压缩需要在其他修改响应的中间件之后
+        app.response_middleware.append(self.compress_response)
+
+    @staticmethod
+    def available_compressors(level: int) -> dict:
+        """按照优先级排列, zlib, brotli以及zstd在压缩时都会释放GIL"""
+        compressors = dict()
+        if brotli is not None:
+            # brotli的quality为0~11, 4以上的压缩速度下降很快
+            compressors["br"] = lambda body: brotli.compress(body, quality=min(level, 4))
+        if zstandard is not None:
+            compressors["zstd"] = zstandard.ZstdCompressor(level=min(level, 19)).compress
+        compressors["gzip"] = lambda body: gzip.compress(body, compresslevel=level, mtime=0)
+        return compressors
+
+    def choose(self, accept_encoding: str):
+        accepted = parse_accept_encoding(accept_encoding)
+        default = accepted.get("*", 0.0)
+        best, best_q = None, 0.0
+        for encoding in self.compressors:
+            q = accepted.get(encoding, default)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def should_compress(self, response) -> bool:
+        if not isinstance(response, HTTPResponse) or response.status != 200:
+            return False
+        if "Content-Encoding" in response.headers:
+            return False
+        content_type = response.headers.get("Content-Type") or response.content_type or ""
+        if content_type.split(";")[0].strip() not in self.mimetypes:
+            return False
+        return len(response.body) >= self.min_size
+
+    async def compress(self, encoding: str, body: bytes) -> bytes:
+        compressor = self.compressors[encoding]
+        if len(body) < self.executor_size:
+            return compressor(body)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, compressor, body)
+
+    async def compress_response(self, request, response):
+        if not self.should_compress(response):
+            return
+
+        vary = response.headers.get("Vary")
+        if not vary:
+            response.headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            response.headers["Vary"] = f"{vary}, Accept-Encoding"
+
+        encoding = self.choose(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return
+
+        etag = response.headers.get("ETag")
+        body = self.cache.get((etag, encoding)) if etag else None
+        if body is None:
+            body = await self.compress(encoding, response.body)
+            if etag:
+                self.cache.set((etag, encoding), body)
+
+        response.body = body
+        response.headers["Content-Encoding"] = encoding
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "encodings": list(self.compressors)}
+
+
+compress = Compress()
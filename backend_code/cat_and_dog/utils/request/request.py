@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import ujson
+from sanic.exceptions import InvalidUsage
 from sanic.request import Request
 
 
@@ -8,3 +10,22 @@ class MyRequest(Request):
     def single_args(self):
         """只取第一个值作为值"""
         return {k: v[0] for k, v in self.args.items()}
+
+    @property
+    def identity_map(self):
+        """请求级别的identity map, 见`IdentityMap`"""
+        return self.ctx.identity_map
+
+    @property
+    def json_rows(self) -> list:
+        """批量接口的数据, JSON数组或者NDJSON(`Content-Type: application/x-ndjson`, 每行一个对象)"""
+        if self.content_type.startswith("application/x-ndjson"):
+            try:
+                return [ujson.loads(line) for line in self.body.splitlines() if line.strip()]
+            except ValueError:
+                raise InvalidUsage("Failed when parsing body as ndjson")
+
+        rows = self.json
+        if not isinstance(rows, list):
+            raise InvalidUsage("批量接口需要JSON数组或者NDJSON")
+        return rows
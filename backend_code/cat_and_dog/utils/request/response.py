@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from hashlib import md5
+
+import ujson
+from sanic.response import HTTPResponse
+
+dumps = partial(ujson.dumps, escape_forward_slashes=False)
+
+
+def json(body, status=200, headers=None, content_type="application/json", **meta):
+    """
+    替代`sanic.response.json`, 2xx的返回数据在序列化时直接包装为
+
+        {"message": "ok", "data": body, **meta}
+
+    只序列化一次, 不再需要在中间件中解码之后重新编码
+
+    :param body: 返回的数据
+    :param meta: 与`data`同级的信息, 如分页的`next`/`total`
+    """
+    if 200 <= status < 300:
+        body = {"message": "ok", "data": body, **meta}
+    return HTTPResponse(dumps(body), headers=headers, status=status, content_type=content_type)
+
+
+def make_etag(content) -> str:
+    """weak ETag, 压缩之后的响应仍然可以使用"""
+    if isinstance(content, str):
+        content = content.encode()
+    return f'W/"{md5(content).hexdigest()}"'
+
+
+def to_utc(value: datetime) -> datetime:
+    """`update_time`等没有时区的时间是服务器的本地时间(`datetime.now`), 转换为UTC"""
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return value.astimezone(timezone.utc)
+
+
+def last_modified_of(data):
+    """
+    详情的dump结果(包括嵌套的关联数据)中最大的`update_time`, 返回UTC时间
+
+    列表不应该使用: 删除一行或者某一行不再满足条件时最大的`update_time`不会改变
+    """
+    latest = None
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            update_time = value.get("update_time")
+            if isinstance(update_time, str) and (latest is None or update_time > latest):
+                latest = update_time
+            stack.extend(v for v in value.values() if isinstance(v, (dict, list)))
+        elif isinstance(value, list):
+            stack.extend(v for v in value if isinstance(v, (dict, list)))
+
+    if latest is None:
+        return None
+    try:
+        return to_utc(datetime.fromisoformat(latest))
+    except ValueError:
+        return None
+
+
+def not_modified(request, etag: str = None, last_modified: datetime = None) -> bool:
+    """
+    `If-None-Match`优先于`If-Modified-Since`, ETag使用弱比较
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().lstrip("W/") for tag in if_none_match.split(",")}
+        return etag.lstrip("W/") in tags
+
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # http的时间精确到秒
+    return to_utc(last_modified).replace(microsecond=0) <= since
+
+
+def conditional_json(request, body, etag: str = None, last_modified: datetime = None, **meta):
+    """
+    带有`ETag`/`Last-Modified`的`json`, 客户端的缓存仍然有效时返回304
+
+    :param etag: 已知的ETag(如详情缓存中保存的), 可以在序列化之前返回304; 为None时使用序列化之后的内容计算
+    :param last_modified: datetime或者ISO格式的字符串, 为None时没有`Last-Modified`, 只使用ETag(如列表)
+    """
+    if isinstance(last_modified, str):
+        last_modified = datetime.fromisoformat(last_modified)
+
+    content = None
+    if etag is None:
+        content = dumps({"message": "ok", "data": body, **meta})
+        etag = make_etag(content)
+
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(to_utc(last_modified), usegmt=True)
+
+    if not_modified(request, etag, last_modified):
+        return HTTPResponse(status=304, headers=headers)
+
+    if content is None:
+        content = dumps({"message": "ok", "data": body, **meta})
+    return HTTPResponse(content, headers=headers, content_type="application/json")
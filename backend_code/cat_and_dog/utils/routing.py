@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 当前请求使用的只读副本, None表示使用主库
+_replica = ContextVar("replica", default=None)
+# 当前请求是否写入过数据
+_wrote = ContextVar("wrote", default=False)
+# 并发执行的子任务使用的独立连接, 见`Gino.isolated_connection`
+_connection = ContextVar("connection", default=None)
+
+
+def current_replica():
+    return _replica.get()
+
+
+def current_connection():
+    return _connection.get()
+
+
+@contextmanager
+def use_connection(connection):
+    """with中的查询都使用该连接, 优先于副本以及主库的路由"""
+    token = _connection.set(connection)
+    try:
+        yield connection
+    finally:
+        _connection.reset(token)
+
+
+def use_replica(engine) -> None:
+    """当前请求之后的查询使用只读副本"""
+    _replica.set(engine)
+
+
+def stick_to_primary() -> None:
+    """
+    写入之后当前请求不再使用只读副本, 保证可以读到刚刚写入的数据
+    """
+    _replica.set(None)
+    _wrote.set(True)
+
+
+def has_written() -> bool:
+    return _wrote.get()
+
+
+@contextmanager
+def primary():
+    """
+    with中的查询使用主库, 如: 缓存未命中时的查询, 避免将副本中过期的数据写入缓存
+
+        with primary():
+            instance = await Model.get(pk)
+    """
+    token = _replica.set(None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)